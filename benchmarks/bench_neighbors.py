@@ -0,0 +1,76 @@
+"""
+Compara las busquedas de los k contactos mas cercanos: NodeArray con numpy,
+NodeArray en Python puro y la busqueda exacta por cotas de bucket de
+RoutingTable.find_neighbors. Comprueba ademas que las tres dan lo mismo.
+
+Uso: python benchmarks/bench_neighbors.py
+"""
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+from kademlia import nodearray
+from kademlia.node import Node
+from kademlia.nodearray import NodeArray
+from kademlia.routing import KBucket, RoutingTable, bucket_span
+from kademlia.utils import digest_lid
+
+K = 20
+LOOKUPS = 200
+
+
+def array_closest(nodes, targets, numpy):
+    saved, nodearray.numpy = nodearray.numpy, numpy
+    try:
+        array = NodeArray()
+        for node in nodes:
+            array.add(node)
+        start = time.perf_counter()
+        result = [[n.id for n in array.closest(t.long_id, K)] for t in targets]
+        return result, time.perf_counter() - start
+    finally:
+        nodearray.numpy = saved
+
+
+def bucket_closest(nodes, targets):
+    # Una tabla con buckets del mismo tamaño, sin indice
+    table = RoutingTable(None, K, nodes[0])
+    table.index = None
+    count = max(1, len(nodes) // K)
+    step = 2 ** 160 // count
+    table.buckets = [KBucket(i * step, (i + 1) * step if i < count - 1
+                             else 2 ** 160, 2 * K) for i in range(count)]
+    table.bounds = [bucket.range[1] for bucket in table.buckets]
+    table.spans = [bucket_span(bucket) for bucket in table.buckets]
+    for node in nodes:
+        table.buckets[table.get_bucket_for(node)].add_node(node)
+    start = time.perf_counter()
+    result = [[n.id for n in table.find_neighbors(t, K)] for t in targets]
+    return result, time.perf_counter() - start
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    random.seed(1)
+    for size in (1000, 10000, 100000):
+        nodes = [Node(digest_lid(i), '10.0.0.1', i) for i in range(size)]
+        targets = [Node(random.getrandbits(160).to_bytes(20, 'big'))
+                   for _ in range(LOOKUPS)]
+        results = {}
+        if nodearray.numpy is not None:
+            results['numpy'] = array_closest(nodes, targets, nodearray.numpy)
+        results['python'] = array_closest(nodes, targets, None)
+        results['buckets'] = bucket_closest(nodes, targets)
+        same = len({str(found) for found, _ in results.values()}) == 1
+        line = ', '.join("%s %.0f lookups/s" % (name, LOOKUPS / elapsed)
+                         for name, (_, elapsed) in results.items())
+        print("%6i contacts: %s (same results: %s)" % (size, line, same))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Mide la decodificacion de listas de contactos de find_node, la creacion de
+Node y la memoria que ocupa cada Node con su ID.
+
+Uso: python benchmarks/bench_nodes.py
+"""
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+from kademlia.node import Node, pack_nodes, unpack_nodes
+from kademlia.utils import digest
+
+ROUNDS = 2000
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    # 10 respuestas de 20 contactos, como las de un rastreo con k = 20
+    contacts = [Node(digest(i), '172.18.0.%i' % (i % 250 + 1), 8468)
+                for i in range(200)]
+    blobs = [pack_nodes(contacts[i:i + 20]) for i in range(0, 200, 20)]
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for blob in blobs:
+            unpack_nodes(blob)
+    elapsed = time.perf_counter() - start
+    print("decode: %.0f contacts/s" % (ROUNDS * len(contacts) / elapsed))
+
+    start = time.perf_counter()
+    for _ in range(20):
+        for i in range(1000):
+            Node(digest(i), '1.2.3.4', 1)
+    elapsed = time.perf_counter() - start
+    print("construct: %.2f us/Node" % (elapsed / 20000 * 1e6))
+
+    tracemalloc.start()
+    nodes = [Node(digest(i), '1.2.3.4', 1) for i in range(10000)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("memory: %.0f bytes/Node (including id)" % (current / len(nodes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Mide cuanto tarda RoutingTable.get_bucket_for en tablas sinteticas con
+buckets del mismo tamaño.
+
+Uso: python benchmarks/bench_routing.py
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+from kademlia.node import Node
+from kademlia.routing import KBucket, RoutingTable
+from kademlia.utils import digest_lid
+
+LOOKUPS = 5000
+
+
+def table_with_buckets(count):
+    table = RoutingTable(None, 20, Node(digest_lid('me')))
+    step = 2 ** 160 // count
+    table.buckets = [KBucket(i * step, (i + 1) * step if i < count - 1
+                             else 2 ** 160, 20) for i in range(count)]
+    table.bounds = [bucket.range[1] for bucket in table.buckets]
+    return table
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    probes = [Node(digest_lid(i)) for i in range(LOOKUPS)]
+    for count in (16, 128, 512, 2048):
+        table = table_with_buckets(count)
+        start = time.perf_counter()
+        for node in probes:
+            table.get_bucket_for(node)
+        elapsed = time.perf_counter() - start
+        print("%5i buckets: %.2f us/lookup" % (count, elapsed / LOOKUPS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
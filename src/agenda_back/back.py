@@ -7,6 +7,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from agenda_back.utils import Back
 
+import copy
 import hashlib
 import time
 import dictdatabase as DDB
@@ -32,10 +33,16 @@ def database():
 
 class Agenda:
 
-    def __init__(self, api) -> None:
+    def __init__(self, api, write_acks=None, consistency_window=30) -> None:
         self.back = Back()
         self.logged_user = None
         self.api = api
+        # A write returns once write_acks replicas stored it (None: the DHT's write quorum)
+        self.write_acks = write_acks
+        # For consistency_window seconds after a write, this session reads its own value
+        # even if a replica still answers with an older one (read-your-writes)
+        self.consistency_window = consistency_window
+        self._writes = {}
 
         self.create_global_group() 
 
@@ -59,14 +66,51 @@ class Agenda:
         else:
             print(f"El group global {global_group_name} ya existe.")
 
+    def session(self):
+        # Shares the api and back with this agenda but keeps its own logged user
+        session = copy.copy(self)
+        session.logged_user = None
+        session._writes = {}
+        return session
+
     def _already_logged(self):
         return self.logged_user is not None
 
+    def _session_write(self, key):
+        token = self._writes.get(str(key))
+        if token is None:
+            return None
+        written_at, value = token
+        if time.monotonic() - written_at > self.consistency_window:
+            del self._writes[str(key)]
+            return None
+        return value
+
     def get(self, key):
         print(f"Key: {key}")
-        data = self.api.get_value(key)[1]
+        return self._load(key, self.api.get_value(key)[1])
+
+    def get_many(self, keys):
+        # One find_values per DHT node instead of one lookup per key
+        keys = list(keys)
+        values = self.api.get_values(keys)
+        return [self._load(key, values[key][1]) for key in keys]
+
+    def _load(self, key, data):
         print(f"Data: {data}")
+        data = self._parse(data)
+
+        # The session's own write wins only while the DHT copy is provably older
+        written = self._session_write(key)
+        if written is not None:
+            if data is None or data.get('version', 0) < written['version']:
+                print("Using this session's last write")
+                return self.back.create(copy.deepcopy(written))
+            del self._writes[str(key)]
 
+        return self.back.create(data)
+
+    def _parse(self, data):
         if data == None or data is None:
             return
         
@@ -88,11 +132,15 @@ class Agenda:
             data = eval(data)
 
         print(f"Struct data: {data}")
-        return self.back.create(data)
+        return data
 
     def set(self, key, value):
-        self.api.set_value(key, value)
-        time.sleep(5)
+        # Every write carries a version, so readers can tell which copy is newer
+        value = dict(value, version=time.time())
+        result = self.api.set_value(key, value, self.write_acks)
+        if result[0]:
+            self._writes[str(key)] = (time.monotonic(), copy.deepcopy(value))
+        return result
 
 
     def login(self, username, password):
@@ -241,17 +289,12 @@ class Agenda:
 
     def get_pending_meetings(self):
         user = self.get(self.logged_user)
-        ans = []
-        for e in user.pending_events:
-            event = self.get(e)
-            ans.append(event)
-        return ans
+        return self.get_many(user.pending_events)
 
     def get_confirmed_meetings(self, username):
         user = self.get(username)
         ans = []
-        for e in user.confirmed_events:
-            event = self.get(e)
+        for event in self.get_many(user.confirmed_events):
             print(f"Event: {event}")
             if event.confirmed:
                 print("Event is confirmed")
@@ -6,24 +6,52 @@ import os
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from api_and_controllers.docker_ import build_image, create_container, remove_dangling, remove_container, cwd
+from api_and_controllers.docker_ import build_image, create_container, remove_dangling, remove_container, container_ip, cwd
+from api_and_controllers.dht_client import DHTClient
 
 class API:
+    # Seconds between lazy re-bootstrap attempts while the client knows no node
+    rebootstrap_interval = 10
+
     def __init__(self):
         print("\U0001F6A7 \U0001F6E0  Building app, please wait...")
         self.image_name = 'script'
         self.image = build_image(cwd, self.image_name)
         remove_dangling()
         self.containers = []
+        self.dht = DHTClient()
+        self._last_bootstrap = 0
 
         self.create_servers()
         print("      \U00002705 Done building")
 
+    def connect_dht(self, port=8468, attempts=5, delay=1):
+        # The first container waits on its broadcast discovery before it
+        # listens, so keep retrying with backoff until a node answers
+        addrs = [(container_ip(container), port) for container in self.containers]
+        for attempt in range(attempts if addrs else 0):
+            if attempt:
+                time.sleep(delay * 2 ** (attempt - 1))
+            self.dht.bootstrap(addrs)
+            if self.dht.has_neighbors():
+                break
+        self._last_bootstrap = time.monotonic()
+        return self.dht.has_neighbors()
+
+    def _dht_ready(self):
+        if self.dht.has_neighbors():
+            return True
+        if time.monotonic() - self._last_bootstrap < self.rebootstrap_interval:
+            return False
+        return self.connect_dht(attempts=1)
+
     def create_servers(self, number_of_servers=3):
         for i in range(number_of_servers):
             self.containers.append(create_container(self.image_name))
             time.sleep(10)
             remove_dangling()
+        # Introduce the client to the new servers
+        self.connect_dht()
 
     def remove_servers(self, cont_id=None):
         to_remove = []
@@ -43,14 +71,30 @@ class API:
             self.containers.remove(container)
         print(f'{len(to_remove)} container(s) removed')
 
-    def set_value(self, key, value):
+    def set_value(self, key, value, min_acks=None):
+        if self._dht_ready():
+            result = self.dht.set(key, str(value), min_acks)
+            return (True, 'Success!!') if result else (False, 'Setting value failed!')
+
         result = create_container(
             self.image_name, ["-o", "set", "-k", str(key), "-v", str(value)])
         remove_dangling()
         return (True, 'Success!!') if result.find('True') != -1 else (False, 'Setting value failed!')
 
     def get_value(self, key):
+        if self._dht_ready():
+            result = self.dht.get(key)
+            return (True, result) if result is not None else (False, None)
+
         result = create_container(
             self.image_name, ["-o", "get", "-k", str(key)])
         remove_dangling()
-        return (True, result) if result != 'None' else (False, None)
\ No newline at end of file
+        return (True, result) if result != 'None' else (False, None)
+
+    def get_values(self, keys):
+        if self._dht_ready():
+            values = self.dht.get_many(keys)
+            return {key: (True, values[key]) if key in values else (False, None)
+                    for key in keys}
+
+        return {key: self.get_value(key) for key in keys}
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import threading
+import uuid
+import sys
+import os
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kademlia.network import Server
+from kademlia.utils import digest
+
+log = logging.getLogger(__name__)
+
+
+class DHTClient:
+    """
+    Cliente persistente del DHT.
+
+    Mantiene un unico `Server` de kademlia (tabla de enrutamiento, socket UDP y
+    event loop) vivo en un hilo propio y lo reutiliza para cada operacion, en
+    lugar de levantar un contenedor por cada get/set.
+    """
+
+    def __init__(self, port=8470, interface='0.0.0.0', timeout=60):
+        """
+        Args:
+            port (int): Puerto UDP en el que escucha el nodo cliente.
+            interface (str): Interfaz en la que escucha el nodo cliente.
+            timeout (int): Tiempo maximo de espera por operacion, en segundos.
+        """
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        # Las lecturas de la agenda van en cadena, asi que se cubre la cola de latencia
+        self.server = Server(interface, node_id=digest(uuid.uuid4()), hedge=True,
+                             stream=True)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self._call(self.server.listen(port, interface))
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _call(self, coro):
+        """
+        Ejecuta una corrutina en el loop del cliente y espera su resultado.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(self.timeout)
+
+    def bootstrap(self, addrs):
+        """
+        Conecta el cliente a la red a traves de los nodos (ip, port) dados.
+        """
+        log.info("Bootstrapping DHT client with %s", addrs)
+        return self._call(self.server.bootstrap(addrs))
+
+    def has_neighbors(self):
+        """
+        Indica si el cliente conoce algun nodo de la red.
+        """
+        return len(self.server.bootstrappable_neighbors()) > 0
+
+    def get(self, key):
+        return self._call(self.server.get(key))
+
+    def get_many(self, keys):
+        """
+        Obtiene varias claves con un solo find_values por nodo (ver
+        :meth:`~kademlia.network.Server.get_many`).
+        """
+        return self._call(self.server.get_many(keys))
+
+    def set(self, key, value, min_acks=None):
+        return self._call(self.server.set(key, value, min_acks))
+
+    def stop(self):
+        """
+        Detiene el servidor y el loop del cliente.
+        """
+        self.loop.call_soon_threadsafe(self.server.stop)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(self.timeout)
@@ -52,6 +52,10 @@ def create_container(image_name, params=[]):
 
     return container
 
+def container_ip(container, net_name='my-network'):
+    container.reload()
+    return container.attrs['NetworkSettings']['Networks'][net_name]['IPAddress']
+
 def remove_container(container):
     container.stop()
     container.remove()
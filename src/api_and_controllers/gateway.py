@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import functools
+import ipaddress
+import json
+import logging
+import socket
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import os
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agenda_back.utils import Back
+
+log = logging.getLogger(__name__)
+
+# Agenda methods that sessions are allowed to call
+METHODS = {
+    'login', 'register', 'logout', 'get_users_from_group', 'get_all_users',
+    'groups_of_user', 'create_group', 'create_pending_meeting',
+    'get_pending_meetings', 'get_confirmed_meetings',
+    'get_pending_group_meetings', 'get_confirmed_group_meetings',
+    'accept_meeting', 'reject_meeting', 'events_created', 'remove_meeting'
+}
+
+# Methods that create or remove Docker containers. The socket is not
+# authenticated, so they are only served when the gateway is started with
+# allow_admin and listens on a loopback interface
+ADMIN_METHODS = {'sudo'}
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def to_json(value):
+    if hasattr(value, 'dicc'):
+        return value.dicc()
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    return value
+
+
+def from_json(value):
+    if isinstance(value, dict) and 'class' in value:
+        return Back().create(value)
+    if isinstance(value, list):
+        return [from_json(v) for v in value]
+    return value
+
+
+class Gateway:
+    """
+    Gateway de la agenda. Un unico proceso asyncio que posee un cliente del
+    DHT y un servicio `Agenda`, y atiende muchas sesiones de usuario
+    concurrentes por un socket local.
+
+    El protocolo es JSON delimitado por lineas. Cada peticion es
+    {"id": n, "session": token, "method": nombre, "params": [...]} y cada
+    respuesta {"id": n, "result": ...} o {"id": n, "error": mensaje}. El
+    metodo "open_session" devuelve un token nuevo y "close_session" lo descarta.
+    Las sesiones abiertas por una conexion se descartan al cerrarse esta.
+    """
+
+    def __init__(self, agenda, host='127.0.0.1', port=8500, workers=16,
+                 allow_admin=False):
+        """
+        Args:
+            agenda: El servicio `agenda_back.back.Agenda` compartido.
+            host (str): Interfaz en la que escucha el gateway.
+            port (int): Puerto TCP en el que escucha el gateway.
+            workers (int): Hilos para ejecutar las operaciones de la agenda.
+            allow_admin (bool): Atender los metodos de ADMIN_METHODS. Solo se
+                permite si el gateway escucha en una interfaz de loopback.
+        """
+        if allow_admin and not is_loopback(host):
+            raise ValueError("Admin methods can only be served on a loopback interface")
+        self.agenda = agenda
+        self.allow_admin = allow_admin
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.sessions = {}
+        self.locks = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_client,
+                                                 self.host, self.port)
+        log.info("Agenda gateway listening on %s:%i", self.host, self.port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+        self.executor.shutdown(wait=False)
+
+    def open_session(self):
+        token = uuid.uuid4().hex
+        self.sessions[token] = self.agenda.session()
+        self.locks[token] = asyncio.Lock()
+        return token
+
+    def close_session(self, token):
+        self.sessions.pop(token, None)
+        self.locks.pop(token, None)
+        return True
+
+    async def _handle_client(self, reader, writer):
+        tokens = set()
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(self._answer(line, writer, tokens))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except ConnectionError:
+            log.info("Gateway client connection lost")
+        finally:
+            # Answer what is already running before dropping the connection
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            for token in tokens:
+                self.close_session(token)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _answer(self, line, writer, tokens):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            result = await self.dispatch(request.get('session'),
+                                         request['method'],
+                                         request.get('params', []))
+            if request['method'] == 'open_session':
+                tokens.add(result)
+            elif request['method'] == 'close_session':
+                tokens.discard(request.get('session'))
+            response = {'id': request_id, 'result': to_json(result)}
+        except Exception as e:
+            log.exception("Error answering gateway request")
+            response = {'id': request_id, 'error': str(e)}
+        if writer.is_closing():
+            return
+        writer.write(json.dumps(response).encode() + b'\n')
+        try:
+            await writer.drain()
+        except ConnectionError:
+            log.info("Gateway client went away before its answer")
+
+    async def dispatch(self, token, method, params):
+        if method == 'open_session':
+            return self.open_session()
+        if method == 'close_session':
+            return self.close_session(token)
+        if method in ADMIN_METHODS:
+            if not self.allow_admin:
+                raise PermissionError(f"Method {method} is disabled on this gateway")
+        elif method not in METHODS:
+            raise ValueError(f"Unknown method {method}")
+        if token not in self.sessions:
+            raise ValueError("Unknown session, call open_session first")
+
+        # The calls of one session run in order, those of different sessions concurrently
+        func = getattr(self.sessions[token], method)
+        async with self.locks[token]:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self.executor, functools.partial(func, *params))
+
+
+class GatewayClient:
+    """
+    Cliente sincrono del gateway con la misma interfaz que `Agenda`.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8500):
+        self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rwb')
+        self.next_id = 0
+        self.token = self._call(None, 'open_session', [])
+
+    def _call(self, token, method, params):
+        self.next_id += 1
+        request = {'id': self.next_id, 'session': token,
+                   'method': method, 'params': list(params)}
+        self.file.write(json.dumps(request).encode() + b'\n')
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return from_json(response['result'])
+
+    def __getattr__(self, name):
+        if name not in METHODS and name not in ADMIN_METHODS:
+            raise AttributeError(name)
+        return lambda *params: self._call(self.token, name, params)
+
+    def close(self):
+        self._call(self.token, 'close_session', [])
+        self.sock.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="interface to listen on",
+                        type=str, default='127.0.0.1')
+    parser.add_argument("-p", "--port", help="port to listen on",
+                        type=int, default=8500)
+    parser.add_argument("--allow-admin", action="store_true",
+                        help="serve the methods that create or remove containers "
+                             "(only on a loopback interface)")
+    args = parser.parse_args()
+    if args.allow_admin and not is_loopback(args.host):
+        parser.error("--allow-admin requires a loopback --host")
+    return args
+
+
+def main():
+    from api_and_controllers.api import API
+    from agenda_back.back import Agenda
+
+    logging.basicConfig(level=logging.INFO)
+    args = parse_arguments()
+    gateway = Gateway(Agenda(API()), args.host, args.port,
+                      allow_admin=args.allow_admin)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(gateway.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.stop()
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
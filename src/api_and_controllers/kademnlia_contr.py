@@ -51,7 +51,7 @@ def discover_nodes(cached_ips, loop):
         for ip in cached_ips:
 #             try to connect to the ip
             try:
-                asyncio.run_coroutine_threadsafe(connect_node(Server(), ip, 8468, loop), loop)
+                asyncio.run_coroutine_threadsafe(connect_node(Server(container_ip, stream=True), ip, 8468, loop), loop)
                 discovered_ips.append(ip)
             except Exception as e:
                 print(e)
@@ -129,7 +129,7 @@ def main(loop):
         ip = ips[0]
         port = 8468
 
-        server = Server(ip)
+        server = Server(ip, stream=True)
 
         if ip == None:
             start_network(server, loop)
@@ -148,7 +148,7 @@ def main(loop):
             connect_node(server, ip, port, loop)
     else:
         print("No nodes found")
-        start_network(Server(), loop)
+        start_network(Server(container_ip, stream=True), loop)
 
 
 if __name__ == "__main__":
@@ -8,11 +8,18 @@ import os
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import agenda_back.back as back_
-from api_and_controllers.api import *
-
-api = API()
-back = back_.Agenda(api)
+# If AGENDA_GATEWAY=host:port is set, use a running gateway instead of building the backend here
+if os.environ.get('AGENDA_GATEWAY'):
+    from api_and_controllers.gateway import GatewayClient
+
+    host, port = os.environ['AGENDA_GATEWAY'].rsplit(':', 1)
+    back = GatewayClient(host, int(port))
+else:
+    import agenda_back.back as back_
+    from api_and_controllers.api import *
+
+    api = API()
+    back = back_.Agenda(api)
 
 class AgendaItem:
     def __init__(self, name, description, time, time_end, date = datetime.datetime.today(), id = 0):
@@ -1,8 +1,8 @@
 from collections import Counter
+import asyncio
 import logging
 
-from kademlia.node import Node, NodeHeap
-from kademlia.utils import gather_dict
+from kademlia.node import Node, NodeHeap, unpack_nodes
 
 
 log = logging.getLogger(__name__)  
@@ -13,7 +13,7 @@ class SpiderCrawl:
     Rastrea la red Kademlia en busca de claves de 160 bits.
     """
 
-    def __init__(self, protocol, node, peers, ksize, alpha):
+    def __init__(self, protocol, node, peers, ksize, alpha, soft_timeout=0.5):
         """
         Crea un nuevo objeto SpiderCrawl para rastrear la red Kademlia.
 
@@ -22,15 +22,18 @@ class SpiderCrawl:
             node: Un nodo que representa la clave que se está buscando.
             peers: Una lista de nodos que se utilizan como punto de entrada a la red.
             ksize: El valor de k para el conjunto de nodos más cercanos.
-            alpha: El valor de alpha para el número de nodos contactados por iteración.
+            alpha: El valor de alpha para el número de solicitudes en curso a la vez.
+            soft_timeout (float): Segundos tras los que un nodo que no responde se
+                                  considera lento y deja de ocupar un lugar de alpha.
         """
 
         self.protocol = protocol
         self.ksize = ksize
         self.alpha = alpha
+        self.soft_timeout = soft_timeout
         self.node = node
         self.nearest = NodeHeap(self.node, self.ksize)
-        self.last_ids_crawled = []
+        self.stale = {}
         log.info("creating spider with peers: %s", peers)
         self.nearest.push(peers)
 
@@ -42,33 +45,113 @@ class SpiderCrawl:
             rpcmethod: El método RPC a utilizar (por ejemplo, call_find_value o call_find_node).
 
         El proceso de búsqueda:
-          1. Llama a find_* para los ALPHA nodos más cercanos que aún no han sido interrogados,
-             agregando los resultados al conjunto actual de nodos más cercanos.
-          2. El conjunto de nodos más cercanos debe llevar un registro de quién ha sido interrogado,
-             ordenado por cercanía y manteniendo solo KSIZE nodos.
-          3. Si el conjunto es el mismo que en la última iteración, la próxima llamada debe ser a todos los nodos que aún no han sido interrogados.
-          4. Repite el proceso hasta que todos los nodos del conjunto más cercano hayan sido interrogados.
+          1. Mantiene ALPHA solicitudes en curso a los nodos más cercanos que aún no han
+             sido interrogados; en cuanto llega cualquier respuesta se agregan sus
+             resultados al conjunto de nodos más cercanos y se lanza la siguiente.
+          2. Un nodo que no responde en `soft_timeout` segundos se marca como lento: sale
+             del conjunto (su lugar lo ocupa el siguiente candidato) y deja de contar para
+             ALPHA. Si más tarde responde, vuelve al conjunto; si falla, se descarta.
+          3. Cuando todos los nodos del conjunto más cercano han sido interrogados y no
+             queda ninguna solicitud en curso que no sea lenta, se siguen esperando las
+             lentas (hasta el plazo del RPC) mientras puedan mejorar el resultado (ver
+             `_wait_for_stale`). Si no, termina y las que sigan pendientes terminan en
+             segundo plano.
         """
         log.info("crawling network with nearest: %s", str(tuple(self.nearest)))
-        count = self.alpha
-        if self.nearest.get_ids() == self.last_ids_crawled:
-            count = len(self.nearest)
-        self.last_ids_crawled = self.nearest.get_ids()
-
-        dicts = {}
-        for peer in self.nearest.get_uncontacted()[:count]:
-            dicts[peer.id] = rpcmethod(peer, self.node)
-            self.nearest.mark_contacted(peer)
-        found = await gather_dict(dicts)
-        return await self._nodes_found(found)
+        loop = asyncio.get_event_loop()
+        pending = {}
+        while True:
+            active = len(pending) - len(self.stale)
+            for peer in self.nearest.get_uncontacted():
+                if active >= self.alpha:
+                    break
+                self.nearest.mark_contacted(peer)
+                task = asyncio.ensure_future(rpcmethod(peer, self.node))
+                pending[task] = (peer, loop.time())
+                active += 1
+
+            if active == 0 and not (pending and self._wait_for_stale()):
+                return self._exhausted()
+
+            # Se espera hasta la primera respuesta o hasta que la solicitud
+            # activa mas vieja agote su plazo blando; si solo quedan lentas,
+            # hasta que alguna termine
+            timeout = None
+            if active:
+                oldest = min(started for peer, started in pending.values()
+                             if peer.id not in self.stale)
+                timeout = max(0, oldest + self.soft_timeout - loop.time())
+            done, _ = await asyncio.wait(pending, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+
+            now = loop.time()
+            for peer, started in pending.values():
+                if peer.id not in self.stale and now - started >= self.soft_timeout:
+                    log.debug("peer %s is slow, moving on", peer)
+                    self.stale[peer.id] = peer
+                    self.nearest.remove([peer.id])
+
+            responses = {}
+            for task in done:
+                peer, _ = pending.pop(task)
+                response = task.result()
+                if self.stale.pop(peer.id, None) is not None and response[0]:
+                    self.nearest.push(peer)
+                responses[peer.id] = response
+            if responses:
+                result = await self._nodes_found(responses)
+                if result is not None:
+                    return result
+
+    def _wait_for_stale(self):
+        """
+        Indica si vale la pena esperar las solicitudes lentas: el conjunto no
+        esta lleno o algun nodo lento esta más cerca que el más lejano de él.
+        """
+        if len(self.nearest) < self.ksize:
+            return True
+        farthest = self.node.distance_to(list(self.nearest)[-1])
+        return any(self.node.distance_to(peer) < farthest
+                   for peer in self.stale.values())
+
+    def _push(self, nodes):
+        """
+        Agrega al conjunto los nodos de una respuesta, salvo los que estan lentos.
+        """
+        self.nearest.push([n for n in nodes if n.id not in self.stale])
 
     async def _nodes_found(self, responses):
+        """
+        Maneja las respuestas recibidas. Devuelve el resultado de la búsqueda
+        si ya puede terminar, o None para seguir buscando.
+        """
+        raise NotImplementedError
+
+    def _exhausted(self):
+        """
+        Resultado de la búsqueda cuando ya no quedan nodos por interrogar.
+        """
         raise NotImplementedError
 
 
 class ValueSpiderCrawl(SpiderCrawl):
-    def __init__(self, protocol, node, peers, ksize, alpha):
-        SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha)
+    def __init__(self, protocol, node, peers, ksize, alpha, soft_timeout=0.5,
+                 hedge=False):
+        """
+        Crea un rastreador de valores.
+
+        Si `hedge` es True, un nodo que no responde dentro del percentil 95 del
+        RTT medido (nunca menos que `min_timeout` del protocolo) se considera
+        lento y su lugar de alpha pasa al siguiente más cercano, que recibe el
+        mismo find_value; gana la primera respuesta. Solo se cubren las
+        solicitudes rezagadas, las demás siguen yendo en paralelo.
+        """
+        if hedge:
+            p95 = protocol.rtt_percentile(95)
+            if p95 is not None:
+                soft_timeout = max(protocol.min_timeout, p95)
+        SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha,
+                             soft_timeout)
         self.nearest_without_value = NodeHeap(self.node, 1)
 
     async def find(self):
@@ -79,7 +162,7 @@ class ValueSpiderCrawl(SpiderCrawl):
 
     async def _nodes_found(self, responses):
         """
-        Maneja el resultado de una iteración de la búsqueda.
+        Maneja las respuestas recibidas. Si alguna trae el valor, la búsqueda termina.
         """
         toremove = []
         found_values = []
@@ -90,16 +173,23 @@ class ValueSpiderCrawl(SpiderCrawl):
             elif response.has_value():
                 found_values.append(response.get_value())
             else:
+                # Puede haber salido del conjunto si llegaron nodos mas cercanos
                 peer = self.nearest.get_node(peerid)
-                self.nearest_without_value.push(peer)
-                self.nearest.push(response.get_node_list())
+                if peer is not None:
+                    self.nearest_without_value.push(peer)
+                self._push(response.get_node_list())
         self.nearest.remove(toremove)
 
         if found_values:
             return await self._handle_found_values(found_values)
-        if self.nearest.have_contacted_all():
-            return None
-        return await self.find()
+        return None
+
+    def _wait_for_stale(self):
+        # Mientras no aparezca el valor, cualquier nodo lento puede tenerlo
+        return True
+
+    def _exhausted(self):
+        return None
 
     async def _handle_found_values(self, values):
         """
@@ -111,7 +201,7 @@ class ValueSpiderCrawl(SpiderCrawl):
             
         peer = self.nearest_without_value.popleft()
         if peer:
-            await self.protocol.call_store(peer, self.node.id, value[1])
+            await self.protocol.call_store(peer, self.node.id.hex(), value[1])
         return value
 
 
@@ -124,7 +214,7 @@ class NodeSpiderCrawl(SpiderCrawl):
 
     async def _nodes_found(self, responses):
         """
-        Maneja el resultado de una iteración de la búsqueda.
+        Maneja las respuestas recibidas. La búsqueda sigue hasta agotar los nodos.
         """
         toremove = []
         for peerid, response in responses.items():
@@ -132,12 +222,20 @@ class NodeSpiderCrawl(SpiderCrawl):
             if not response.happened():
                 toremove.append(peerid)
             else:
-                self.nearest.push(response.get_node_list())
+                self._push(response.get_node_list())
         self.nearest.remove(toremove)
+        return None
 
-        if self.nearest.have_contacted_all():
-            return list(self.nearest)
-        return await self.find()
+    def _exhausted(self):
+        """
+        Los nodos lentos que no respondieron aun quedan como candidatos si no
+        hay suficientes nodos que sí lo hicieron.
+        """
+        nodes = list(self.nearest)
+        if len(nodes) < self.ksize and self.stale:
+            nodes = sorted(nodes + list(self.stale.values()),
+                           key=self.node.distance_to)[:self.ksize]
+        return nodes
 
 
 class RPCFindResponse:
@@ -167,6 +265,9 @@ class RPCFindResponse:
     def get_node_list(self):
         """
         Obtener la lista de nodos en la respuesta.  Si no hay valor, se establece.
+        Acepta tanto el blob compacto de pack_nodes como una lista de tuplas.
         """
         nodelist = self.response[1] or []
+        if isinstance(nodelist, bytes):
+            return unpack_nodes(nodelist)
         return [Node(*nodeple) for nodeple in nodelist]
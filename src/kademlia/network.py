@@ -5,14 +5,18 @@ import random
 import pickle
 import asyncio
 import logging
+import time
 import uuid
 
 from kademlia.protocol import KademliaProtocol
-from kademlia.utils import digest
+from kademlia.utils import digest, LoopMonitor, Histogram
+from kademlia.utils import compress_value, decompress_value
 from kademlia.storage import Storage, ForgetfulStorage
 from kademlia.node import Node
 from kademlia.crawling import ValueSpiderCrawl
 from kademlia.crawling import NodeSpiderCrawl
+from kademlia.republish import RepublishSchedule
+from kademlia.rpctcp import RPCStream
 
 log = logging.getLogger(__name__)  
 
@@ -25,7 +29,11 @@ class Server:
 
     protocol_class = KademliaProtocol
 
-    def __init__(self, ip, ksize=3, alpha=2, node_id=None, storage=None):
+    # Los valores de texto mas largos se publican comprimidos (ver compress_value)
+    compress_values_above = 1024
+
+    def __init__(self, ip, ksize=3, alpha=2, node_id=None, storage=None,
+                 republish=None, write_quorum=1, hedge=False, stream=False):
         """
         Crea una instancia de server. Este comenzará a escuchar en el puerto dado.
 
@@ -33,37 +41,73 @@ class Server:
             ksize (int): El parámetro k del documento
             alpha (int): El parámetro alpha del documento
             node_id: El ID para este nodo en la red.
-            storage: Una instancia que implementa la interfaz
-                    :class:`~kademlia.storage.IStorage`
+            storage: Una instancia que implementa la interfaz de
+                    :class:`~kademlia.storage.Storage` (por ejemplo
+                    :class:`~kademlia.storage.LogStorage`). Por defecto Storage.
+            republish: Un :class:`~kademlia.republish.RepublishSchedule` con los
+                    intervalos de republicacion. Por defecto los del paper.
+            write_quorum (int): Cantidad de replicas que deben confirmar una
+                    escritura (W) cuando set no indica otra.
+            hedge (bool): Si es True, get usa solicitudes con cobertura: si el
+                    nodo consultado tarda mas que el percentil 95 del RTT, se
+                    pregunta tambien al siguiente y gana la primera respuesta.
+            stream (bool): Si es True, el nodo tambien escucha por TCP en el
+                    mismo puerto y envia por ahi las transferencias grandes
+                    (ver :class:`~kademlia.rpctcp.RPCStream`).
         """
         self.id = uuid.uuid4()
         self.ksize = ksize
         self.alpha = alpha
-        self.storage = Storage(self.id)
+        self.storage = storage if storage is not None else Storage(self.id)
+        self.republish = republish if republish is not None else RepublishSchedule()
         self.node = Node(node_id or digest(ip))
         self.transport = None
         self.protocol = None
         self.refresh_loop = None
         self.save_state_loop = None
+        self.flush_loop = None
+        self.cull_loop = None
+        self.loop_monitor = LoopMonitor()
+        self.write_quorum = write_quorum
+        self.write_latency = Histogram()
+        self.hedge = hedge
+        self.stream = stream
 
     def stop(self):
         """
-        Detiene el servidor.
+        Detiene el servidor. Primero se cancelan las tareas periodicas, y el
+        ultimo volcado del almacenamiento se hace en su hilo sin esperarlo.
         """
-        if self.transport is not None:
-            self.transport.close()
-
         if self.refresh_loop:
             self.refresh_loop.cancel()
 
         if self.save_state_loop:
             self.save_state_loop.cancel()
 
+        if self.flush_loop:
+            self.flush_loop.cancel()
+
+        if self.cull_loop:
+            self.cull_loop.cancel()
+
+        if self.transport is not None:
+            self.transport.close()
+
+        if self.protocol is not None and self.protocol.stream is not None:
+            self.protocol.stream.stop()
+
+        self.loop_monitor.stop()
+        if self.protocol is not None:
+            self.protocol.stop_storage()
+        else:
+            self.storage.flush()
+
     def _create_protocol(self):
         """
         Crea una instancia del protocolo Kademlia.
         """
-        return self.protocol_class(self.node, self.storage, self.ksize)
+        return self.protocol_class(self.node, self.storage, self.ksize,
+                                   republish=self.republish)
 
     async def listen(self, port, interface='0.0.0.0'):
         """
@@ -79,7 +123,16 @@ class Server:
         self.node.ip = interface
         self.node.port = port
         self.transport, self.protocol = await listen
+        if self.stream:
+            self.protocol.stream = RPCStream(self.protocol)
+            await self.protocol.stream.listen(port, interface)
+        self.loop_monitor.start()
+        stored = await self.protocol.run_storage(list, self.storage)
+        for dkey, _ in stored:
+            self.republish.track(dkey)
         self.refresh_table()
+        self.flush_storage()
+        self.cull_storage()
 
     def refresh_table(self):
         """
@@ -90,9 +143,28 @@ class Server:
         loop = asyncio.get_event_loop()
         self.refresh_loop = loop.call_later(30, self.refresh_table)
 
+    def flush_storage(self, frequency=5):
+        """
+        Vuelca periodicamente a disco las escrituras pendientes del almacenamiento.
+        """
+        asyncio.ensure_future(self.protocol.run_storage(self.storage.flush))
+        loop = asyncio.get_event_loop()
+        self.flush_loop = loop.call_later(frequency, self.flush_storage,
+                                          frequency)
+
+    def cull_storage(self, frequency=60):
+        """
+        Elimina periodicamente del almacenamiento las claves caducadas.
+        """
+        asyncio.ensure_future(self.protocol.run_storage(self.storage.cull))
+        loop = asyncio.get_event_loop()
+        self.cull_loop = loop.call_later(frequency, self.cull_storage,
+                                         frequency)
+
     async def _refresh_table(self):
         """
         Actualiza los buckets que no han tenido ninguna búsqueda en la última hora
+        y republica las claves cuyo plazo de republicación venció.
         """
         results = []
         for node_id in self.protocol.get_refresh_ids():
@@ -105,9 +177,61 @@ class Server:
 
         await asyncio.gather(*results)
 
-        for dkey, value in self.storage:
-            data = self.storage.get(dkey)
-            await self.set_refresh(dkey, data)
+        # Solo se republican las claves cuyo plazo vencio, como mucho
+        # max_per_cycle por ciclo; el resto espera al siguiente
+        due = self.republish.due()
+        if not due:
+            return
+        entries = await self.protocol.run_storage(self.storage.get_many, due)
+        for dkey in due:
+            if dkey not in entries:
+                self.republish.discard(dkey)
+        await self._republish(entries)
+        for dkey in entries:
+            self.republish.republished(dkey)
+
+    async def _republish(self, entries):
+        """
+        Republica un lote de entradas (clave -> (marca de tiempo, valor)).
+
+        Las claves se agrupan por region del espacio de claves, de modo que
+        claves cercanas, que comparten sus k nodos mas cercanos, se resuelven
+        con una sola busqueda por region. Luego cada nodo destino recibe todas
+        sus claves en un unico mensaje refresh_many.
+        """
+        # Regiones de tamaño tal que cada una contenga del orden de k nodos conocidos
+        contacts = sum(len(bucket) for bucket in self.protocol.router.buckets)
+        bits = max(0, (contacts // self.ksize).bit_length() - 1)
+        regions = {}
+        for dkey, data in entries.items():
+            keynode = Node(dkey)
+            region = keynode.long_id >> (160 - bits)
+            regions.setdefault(region, []).append((keynode, dkey, data))
+
+        async def crawl(region):
+            target = region[0][0]
+            nearest = self.protocol.router.find_neighbors(target)
+            if not nearest:
+                return []
+            spider = NodeSpiderCrawl(self.protocol, target, nearest,
+                                     self.ksize * 2, self.alpha)
+            return await spider.find()
+
+        regions = list(regions.values())
+        found = await asyncio.gather(*[crawl(region) for region in regions])
+
+        batches = {}
+        for region, nodes in zip(regions, found):
+            for keynode, dkey, data in region:
+                closest = sorted(nodes, key=keynode.distance_to)[:self.ksize]
+                for node in closest:
+                    batches.setdefault(node.id, (node, []))[1].append((dkey, data))
+
+        log.debug("republishing %i keys in %i regions to %i nodes",
+                  len(entries), len(regions), len(batches))
+        results = [self.protocol.call_refresh_many(node, items)
+                   for node, items in batches.values()]
+        await asyncio.gather(*results)
 
     def bootstrappable_neighbors(self):
         """
@@ -157,7 +281,7 @@ class Server:
         dkey = key
         if not refresh:
             dkey = digest(key)
-        res_self = self.storage.get(dkey)
+        res_self = await self.protocol.storage_get(dkey)
         log.debug("RESULT GET SELF: %s", res_self)
 
         node = Node(dkey)
@@ -166,26 +290,83 @@ class Server:
             log.warning("There are no known neighbors to get key %s", key)
             return None
         spider = ValueSpiderCrawl(self.protocol, node, nearest,
-                                  self.ksize, self.alpha)
+                                  self.ksize, self.alpha, hedge=self.hedge)
         result = await spider.find()
 
         # log.debug("RESULT GET: %s", result)
 
         if res_self is not None and result is not None:
             if res_self[0] > result[0]:
-                return res_self[1] 
+                return decompress_value(res_self[1])
             else:
-                self.storage[dkey] = result[1]
-                return result[1]
+                await self.protocol.run_storage(self.storage.__setitem__,
+                                                dkey, result[1])
+                self.republish.received(dkey)
+                return decompress_value(result[1])
         if res_self is not None:
-            return res_self[1]
+            return decompress_value(res_self[1])
         if result is not None:
-            return result[1]
+            return decompress_value(result[1])
         return None
 
-    async def set(self, key, value):
+    async def get_many(self, keys):
+        """
+        Obtiene varias claves a la vez. Cada clave se pide a sus `ksize`
+        contactos conocidos mas cercanos (sus replicas), agrupando las claves
+        por contacto: a cada uno se le piden todas las suyas con un solo
+        find_values. De cada clave se queda la entrada mas nueva entre las
+        replicas que respondieron y la local. Las claves que ninguna replica
+        tiene se buscan con get, en paralelo.
+
+        Returns:
+            Un diccionario con el valor de cada clave encontrada.
+        """
+        dkeys = {digest(key): key for key in keys}
+        local = await self.protocol.run_storage(self.storage.get_many,
+                                                list(dkeys))
+
+        groups = {}
+        for dkey in dkeys:
+            for node in self.protocol.router.find_neighbors(Node(dkey)):
+                groups.setdefault(node.id, (node, []))[1].append(dkey)
+        responses = await asyncio.gather(*[
+            self.protocol.call_find_values(node, group)
+            for node, group in groups.values()])
+        remote = {}
+        for (node, group), response in zip(groups.values(), responses):
+            if not response[0] or not isinstance(response[1], dict):
+                continue
+            values = response[1].get('values') or {}
+            for dkey in group:
+                entry = values.get(dkey)
+                if entry is not None and (dkey not in remote
+                                          or entry[0] > remote[dkey][0]):
+                    remote[dkey] = entry
+
+        found = {}
+        for dkey, entry in remote.items():
+            if dkey in local and local[dkey][0] > entry[0]:
+                found[dkeys[dkey]] = decompress_value(local[dkey][1])
+                continue
+            await self.protocol.run_storage(self.storage.__setitem__,
+                                            dkey, entry[1])
+            self.republish.received(dkey)
+            found[dkeys[dkey]] = decompress_value(entry[1])
+
+        missing = [key for dkey, key in dkeys.items() if dkey not in remote]
+        values = await asyncio.gather(*[self.get(key) for key in missing])
+        found.update((key, value) for key, value in zip(missing, values)
+                     if value is not None)
+        return found
+
+    async def set(self, key, value, min_acks=None):
         """
         Asigna la clave de cadena dada al valor dado en la red.
+
+        Args:
+            min_acks (int): Cantidad de replicas que deben confirmar el
+                            almacenamiento para considerar exitosa la escritura.
+                            Por defecto write_quorum.
         """
         if not check_dht_value_type(value):
             raise TypeError(
@@ -193,12 +374,25 @@ class Server:
             )
         log.info("setting '%s' = '%s' on network", key, value)
         dkey = digest(key)
-        return await self.set_digest(dkey, value)
+        return await self.set_digest(dkey, value, min_acks)
 
-    async def set_digest(self, dkey, value):
+    async def set_digest(self, dkey, value, min_acks=None):
         """
         Asigna la clave SHA1 dada (bytes) al valor dado en la red.
+
+        Devuelve True en cuanto `min_acks` (por defecto write_quorum) de los
+        nodos mas cercanos, o todos si hay menos, confirman el almacenamiento.
+        Los demas almacenamientos terminan en segundo plano.
+
+        Los valores grandes se comprimen aqui, una sola vez; se guardan y se
+        republican comprimidos y get los descomprime.
         """
+        if min_acks is None:
+            min_acks = self.write_quorum
+        # Fuera del event loop: comprimir un valor grande lleva su tiempo
+        loop = asyncio.get_event_loop()
+        value = await loop.run_in_executor(None, compress_value, value,
+                                           self.compress_values_above)
         node = Node(dkey)
 
         nearest = self.protocol.router.find_neighbors(node)
@@ -211,14 +405,30 @@ class Server:
         spider = NodeSpiderCrawl(self.protocol, node, nearest,
                                     self.ksize, self.alpha)
         nodes = await spider.find()
+        if not nodes:
+            log.warning("No node answered the lookup for key %s", dkey)
+            return False
         log.info("setting '%s' on %s", dkey, list(map(str, nodes)))
         log.debug("NODES SET DIGEST %s",nodes)
+        self.republish.published(dkey)
 
         biggest = max([n.distance_to(node) for n in nodes])
         if self.node.distance_to(node) < biggest:
-            self.storage[dkey] = value
-        results = [self.protocol.call_store(n, dkey, value) for n in nodes]
-        return any(await asyncio.gather(*results))
+            await self.protocol.run_storage(self.storage.__setitem__,
+                                            dkey, value)
+        stores = [asyncio.ensure_future(self.protocol.call_store(n, dkey, value))
+                  for n in nodes]
+        quorum = min(min_acks, len(stores))
+        acks = 0
+        start = time.monotonic()
+        for store in asyncio.as_completed(stores):
+            result = await store
+            if result[0]:
+                acks += 1
+                if acks >= quorum:
+                    break
+        self.write_latency.record(time.monotonic() - start)
+        return acks >= quorum
 
     async def set_refresh(self, dkey, value):
         """
@@ -1,31 +1,48 @@
+from collections import OrderedDict
 from operator import itemgetter
 import heapq
+import ipaddress
 import logging
+import struct
 from kademlia.utils import digest_lid
 
 log = logging.getLogger(__name__)  
 
+# Version del formato compacto de listas de contactos
+CONTACTS_VERSION = 1
+PORT = struct.Struct('>H')
+
 
 class Node:
     """
     Representa un nodo en la red Kademlia.
     """
 
+    __slots__ = ('id', 'ip', 'port', 'long_id')
+
     def __init__(self, node_id, ip=None, port=None):
         """
         Crea una instancia de Node.
 
+        El ID se guarda como 20 bytes: un ID de 20 bytes se usa tal cual, un
+        SHA1 en hexadecimal (como los de `digest`) se decodifica y cualquier
+        otro valor se resume con SHA1. El ID largo es ese mismo valor como entero.
+
         Args:
-            node_id (int): El ID del nodo.
+            node_id: El ID del nodo.
             ip (str): La dirección IP del nodo (opcional).
             port (int): El puerto del nodo (opcional).
         """
-        self.id = node_id  
-        log.debug("NODE CREATED WITH ID: %s", self.id)
-        self.ip = ip  
+        if not (isinstance(node_id, bytes) and len(node_id) == 20):
+            try:
+                raw_id = bytes.fromhex(node_id)
+            except (TypeError, ValueError):
+                raw_id = b''
+            node_id = raw_id if len(raw_id) == 20 else digest_lid(node_id)
+        self.id = node_id
+        self.ip = ip
         self.port = port
-        self.long_id = int(digest_lid(node_id).hex(), 16)
-        log.debug("NODE'S LONG ID: %s", self.long_id)
+        self.long_id = int.from_bytes(node_id, 'big')
 
     def same_home_as(self, node):
         """
@@ -58,9 +75,78 @@ class Node:
         return "%s:%s" % (self.ip, str(self.port))
 
 
+def pack_nodes(nodes):
+    """
+    Codifica una lista de nodos en un unico blob compacto: un byte de version
+    y, por cada nodo, su ID de 20 bytes, la longitud de su direccion (4 u 16),
+    la direccion empaquetada y el puerto en 2 bytes.
+
+    Si algun nodo no tiene una IP numerica o un puerto, devuelve la lista de
+    tuplas (ID, IP, puerto) de siempre.
+    """
+    parts = [bytes([CONTACTS_VERSION])]
+    try:
+        for node in nodes:
+            address = ipaddress.ip_address(node.ip).packed
+            parts.append(node.id + bytes([len(address)]) + address
+                         + PORT.pack(node.port))
+    except (TypeError, ValueError, struct.error):
+        return list(map(tuple, nodes))
+    return b''.join(parts)
+
+
+# Contactos decodificados recientemente, para reutilizar sus Node
+_contacts = OrderedDict()
+MAX_CONTACTS = 4096
+
+
+def unpack_nodes(blob):
+    """
+    Decodifica un blob de pack_nodes en una lista de nodos. Los contactos que
+    se repiten entre respuestas comparten el mismo Node.
+
+    Si el blob esta truncado o tiene una direccion de longitud invalida, se
+    devuelven los contactos completos leidos hasta ese punto.
+    """
+    if not blob or blob[0] != CONTACTS_VERSION:
+        log.warning("unknown contact list format, ignoring it")
+        return []
+    nodes = []
+    offset = 1
+    while offset < len(blob):
+        size = blob[offset + 20] if offset + 20 < len(blob) else None
+        end = offset + 21 + (size or 0) + PORT.size
+        if size not in (4, 16) or end > len(blob):
+            log.warning("malformed contact list, keeping the first %i contacts",
+                        len(nodes))
+            break
+        entry = blob[offset:end]
+        node = _contacts.get(entry)
+        if node is None:
+            address = entry[21:21 + size]
+            port, = PORT.unpack_from(entry, 21 + size)
+            node = Node(entry[:20], str(ipaddress.ip_address(address)), port)
+            _contacts[entry] = node
+            if len(_contacts) > MAX_CONTACTS:
+                _contacts.popitem(last=False)
+        nodes.append(node)
+        offset = end
+    return nodes
+
+
 class NodeHeap:
     """
-    Un heap de nodos ordenados por distancia a un nodo dado.
+    Los nodos más cercanos a un nodo dado, como mucho `maxsize`.
+
+    Los nodos se indexan por ID en un diccionario, de modo que comprobar si
+    un nodo está o buscarlo es O(1). Un max-heap por distancia, con borrado
+    perezoso, permite descartar el más lejano en O(log n) cuando llega uno
+    más cercano y el montón está lleno. La vista ordenada se calcula solo
+    cuando cambia el contenido.
+
+    Los candidatos que no caben, o que salen al llegar uno más cercano, se
+    guardan en un min-heap de reserva (como mucho `2 * maxsize`) para volver
+    a llenar el montón cuando se eliminan nodos con `remove` o `popleft`.
     """
 
     def __init__(self, node, maxsize):
@@ -72,31 +158,81 @@ class NodeHeap:
             maxsize: El tamaño máximo del montón.
         """
         self.node = node
+        self.entries = {}
         self.heap = []
         self.contacted = set()
         self.maxsize = maxsize
+        self.spare = []
+        self.spare_nodes = {}
+        self._sorted = None
+
+    def _farthest(self):
+        """
+        Devuelve la entrada (-distancia, ID) más lejana que sigue en el montón,
+        descartando las borradas.
+        """
+        while self.heap:
+            distance, node_id = self.heap[0]
+            entry = self.entries.get(node_id)
+            if entry is not None and entry[0] == -distance:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+        return None
+
+    def _reserve(self, distance, node):
+        """
+        Guarda un candidato que no cabe en el montón. Si la reserva duplica
+        `maxsize` se queda solo con los `maxsize` más cercanos.
+        """
+        if node.id in self.spare_nodes:
+            return
+        self.spare_nodes[node.id] = node
+        heapq.heappush(self.spare, (distance, node.id))
+        if len(self.spare) > 2 * self.maxsize:
+            # Una lista ordenada ya es un heap válido
+            self.spare = heapq.nsmallest(self.maxsize, set(
+                entry for entry in self.spare if entry[1] in self.spare_nodes))
+            self.spare_nodes = {node_id: self.spare_nodes[node_id]
+                                for _, node_id in self.spare}
+
+    def _refill(self):
+        """
+        Completa el montón hasta `maxsize` con los candidatos de reserva más
+        cercanos.
+        """
+        while len(self.entries) < self.maxsize and self.spare:
+            distance, node_id = heapq.heappop(self.spare)
+            node = self.spare_nodes.pop(node_id, None)
+            if node is None or node_id in self.entries:
+                continue
+            self.entries[node_id] = (distance, node)
+            heapq.heappush(self.heap, (-distance, node_id))
+            self._sorted = None
+
+    def _discard(self, node_id):
+        if self.entries.pop(node_id, None) is not None:
+            self._sorted = None
+        self.spare_nodes.pop(node_id, None)
+        self._refill()
+        # Si las entradas borradas dominan el heap, se reconstruye
+        if len(self.heap) > 2 * len(self.entries) + 16:
+            self.heap = [(-distance, node_id)
+                         for node_id, (distance, _) in self.entries.items()]
+            heapq.heapify(self.heap)
 
     def remove(self, peers):
         """
         Elimina una lista de IDs de nodos del heap. 
         """
-        peers = set(peers)
-        if not peers:
-            return
-        nheap = []
-        for distance, node in self.heap:
-            if node.id not in peers:
-                heapq.heappush(nheap, (distance, node))
-        self.heap = nheap
+        for node_id in peers:
+            self._discard(node_id)
 
     def get_node(self, node_id):
         """
         Obtiene un nodo del montón por su ID.
         """
-        for _, node in self.heap:
-            if node.id == node_id:
-                return node
-        return None
+        entry = self.entries.get(node_id)
+        return entry[1] if entry is not None else None
 
     def have_contacted_all(self):
         """
@@ -120,11 +256,16 @@ class NodeHeap:
         """
         Elimina y devuelve el nodo más cercano al nodo actual.
         """
-        return heapq.heappop(self.heap)[1] if self else None
+        if not self:
+            return None
+        node = next(iter(self))
+        self._discard(node.id)
+        return node
 
     def push(self, nodes):
         """
-        Agrega nodos al heap.
+        Agrega nodos al heap. Si está lleno, un nodo nuevo solo entra si está
+        más cerca que el más lejano, que pasa a la reserva.
 
         Args:
             nodes: Un nodo o una lista de nodos.
@@ -133,31 +274,40 @@ class NodeHeap:
             nodes = [nodes]
 
         for node in nodes:
-            if node not in self:
-                distance = self.node.distance_to(node)
-                heapq.heappush(self.heap, (distance, node))
+            if node.id in self.entries:
+                continue
+            distance = self.node.distance_to(node)
+            if len(self.entries) >= self.maxsize:
+                farthest = self._farthest()
+                if farthest is None or distance >= -farthest[0]:
+                    self._reserve(distance, node)
+                    continue
+                heapq.heappop(self.heap)
+                self._reserve(*self.entries.pop(farthest[1]))
+            self.entries[node.id] = (distance, node)
+            heapq.heappush(self.heap, (-distance, node.id))
+            self._sorted = None
 
     def __len__(self):
         """
         Devuelve el tamaño del heap.
         """
-        return min(len(self.heap), self.maxsize)
+        return len(self.entries)
 
     def __iter__(self):
         """
-        Permite iterar sobre los nodos del heap.
+        Permite iterar sobre los nodos del heap, del más cercano al más lejano.
         """
-        nodes = heapq.nsmallest(self.maxsize, self.heap)
-        return iter(map(itemgetter(1), nodes))
+        if self._sorted is None:
+            entries = sorted(self.entries.values(), key=itemgetter(0))
+            self._sorted = [node for _, node in entries]
+        return iter(self._sorted)
 
     def __contains__(self, node):
         """
         Verifica si un nodo está presente en el heap.
         """
-        for _, other in self.heap:
-            if node.id == other.id:
-                return True
-        return False
+        return node.id in self.entries
 
     def get_uncontacted(self):
         """
@@ -0,0 +1,93 @@
+"""
+Almacen de contactos en arrays para ordenar por distancia XOR en bloque.
+"""
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Un ID de 160 bits se guarda en 5 palabras de 32 bits, la mas significativa primero
+LANES = 5
+LANE_BITS = 32
+LANE_MASK = (1 << LANE_BITS) - 1
+
+
+def to_lanes(long_id):
+    return [(long_id >> (LANE_BITS * (LANES - 1 - i))) & LANE_MASK
+            for i in range(LANES)]
+
+
+class NodeArray:
+    """
+    Guarda los IDs largos de un conjunto de nodos como filas de 5 enteros
+    uint32 y devuelve los k mas cercanos a un ID con una sola pasada
+    vectorizada: XOR por palabras y ordenacion lexicografica de las palabras.
+
+    Si numpy no esta instalado se usa heapq.nsmallest sobre los enteros de
+    Python, con el mismo resultado.
+    """
+
+    def __init__(self, capacity=64):
+        self.nodes = []
+        self.positions = {}
+        if numpy is not None:
+            self.lanes = numpy.zeros((capacity, LANES), dtype=numpy.uint32)
+
+    def add(self, node):
+        """
+        Agrega un nodo, o lo reemplaza si ya habia uno con su ID.
+        """
+        position = self.positions.get(node.id)
+        if position is not None:
+            self.nodes[position] = node
+            return
+        position = len(self.nodes)
+        self.positions[node.id] = position
+        self.nodes.append(node)
+        if numpy is not None:
+            if position == len(self.lanes):
+                self.lanes = numpy.concatenate([self.lanes,
+                                                numpy.zeros_like(self.lanes)])
+            self.lanes[position] = to_lanes(node.long_id)
+
+    def discard(self, node):
+        """
+        Quita un nodo; su lugar lo ocupa el ultimo.
+        """
+        position = self.positions.pop(node.id, None)
+        if position is None:
+            return
+        last = self.nodes.pop()
+        if position < len(self.nodes):
+            self.nodes[position] = last
+            self.positions[last.id] = position
+            if numpy is not None:
+                self.lanes[position] = self.lanes[len(self.nodes)]
+
+    def closest(self, long_id, k):
+        """
+        Devuelve los k nodos mas cercanos a `long_id`, del mas cercano al mas lejano.
+        """
+        count = len(self.nodes)
+        if numpy is None:
+            return heapq.nsmallest(k, self.nodes,
+                                   key=lambda node: node.long_id ^ long_id)
+        if count == 0:
+            return []
+
+        distances = self.lanes[:count] ^ numpy.array(to_lanes(long_id),
+                                                     dtype=numpy.uint32)
+        candidates = numpy.arange(count)
+        if count > k:
+            # Solo pueden estar entre los k primeros los que no superan la
+            # k-esima menor palabra alta
+            kth = numpy.partition(distances[:, 0], k - 1)[k - 1]
+            candidates = numpy.flatnonzero(distances[:, 0] <= kth)
+            distances = distances[candidates]
+        order = numpy.lexsort(distances.T[::-1])[:k]
+        return [self.nodes[i] for i in candidates[order]]
+
+    def __len__(self):
+        return len(self.nodes)
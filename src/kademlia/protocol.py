@@ -1,21 +1,52 @@
 import random
 import asyncio
+import functools
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import umsgpack
 
 from kademlia.rpcudp import RPCProtocol
 
-from kademlia.node import Node
+from kademlia.node import Node, pack_nodes
+from kademlia.republish import RepublishSchedule
 from kademlia.routing import RoutingTable
-from kademlia.utils import digest
+from kademlia.storage import NOT_CACHED
 
 log = logging.getLogger(__name__)  
 
 
+def chunk_items(items, limit=7168):
+    """
+    Divide una lista de elementos en trozos cuyo tamaño empaquetado con
+    msgpack no supere `limit` bytes, para que cada trozo quepa en un mensaje RPC.
+    """
+    chunk, size = [], 0
+    for item in items:
+        item_size = len(umsgpack.packb(item))
+        if chunk and size + item_size > limit:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(item)
+        size += item_size
+    if chunk:
+        yield chunk
+
+
 class KademliaProtocol(RPCProtocol):
     """
     Implementa el protocolo Kademlia utilizando RPC UDP para la comunicación entre nodos.
     """
-    def __init__(self, source_node, storage, ksize):
+
+    # Si es False las operaciones del almacenamiento se ejecutan en el event loop
+    offload_storage = True
+
+    # Transferencias masivas: traspaso de claves y republicacion
+    bulk_rpcs = frozenset({'store_many', 'refresh_many'})
+
+    def __init__(self, source_node, storage, ksize, max_pending_io=64,
+                 republish=None):
         """
         Inicializa el protocolo Kademlia.
 
@@ -23,11 +54,62 @@ class KademliaProtocol(RPCProtocol):
             source_node: El nodo actual.
             storage: El almacenamiento local del nodo.
             ksize: El tamaño de la tabla de enrutamiento.
+            max_pending_io (int): Cantidad maxima de operaciones del almacenamiento
+                                  encoladas en el hilo de entrada/salida.
+            republish: El RepublishSchedule donde se registran las claves recibidas.
         """
         RPCProtocol.__init__(self)
         self.router = RoutingTable(self, ksize, source_node)
         self.storage = storage
         self.source_node = source_node
+        self.storage_executor = ThreadPoolExecutor(max_workers=1)
+        self._io_slots = asyncio.Semaphore(max_pending_io)
+        self.storage_stats = {'inline': 0, 'offloaded': 0, 'io_time': 0.0}
+        self.republish = republish if republish is not None else RepublishSchedule()
+
+    async def run_storage(self, func, *args, **kwargs):
+        """
+        Ejecuta una operacion del almacenamiento en el hilo de entrada/salida,
+        para no bloquear el event loop mientras se accede al disco. Como mucho
+        hay `max_pending_io` operaciones encoladas; el resto espera su turno.
+        """
+        if not self.offload_storage or not getattr(self.storage, 'blocking', True):
+            self.storage_stats['inline'] += 1
+            return func(*args, **kwargs)
+
+        async with self._io_slots:
+            # El servidor pudo detenerse mientras se esperaba turno
+            if not self.offload_storage:
+                self.storage_stats['inline'] += 1
+                return func(*args, **kwargs)
+            loop = asyncio.get_event_loop()
+            start = time.monotonic()
+            result = await loop.run_in_executor(
+                self.storage_executor, functools.partial(func, *args, **kwargs))
+            self.storage_stats['offloaded'] += 1
+            self.storage_stats['io_time'] += time.monotonic() - start
+            return result
+
+    def stop_storage(self):
+        """
+        Deja de usar el hilo de entrada/salida: le encola un ultimo flush y lo
+        cierra sin esperarlo, para no bloquear el event loop. Las operaciones
+        que lleguen despues se hacen en linea.
+        """
+        self.offload_storage = False
+        self.storage_executor.submit(self.storage.flush)
+        self.storage_executor.shutdown(wait=False)
+
+    async def storage_get(self, key, default=None):
+        """
+        Obtiene una entrada del almacenamiento. Si puede resolverse en memoria
+        se responde directamente, sin pasar por el hilo de entrada/salida.
+        """
+        entry = self.storage.peek(key)
+        if entry is not NOT_CACHED:
+            self.storage_stats['inline'] += 1
+            return default if entry is None else entry
+        return await self.run_storage(self.storage.get, key, default)
 
     def get_refresh_ids(self):
         """
@@ -61,7 +143,7 @@ class KademliaProtocol(RPCProtocol):
         
         return self.source_node.id
 
-    def rpc_refresh(self, sender, nodeid, key, value):
+    async def rpc_refresh(self, sender, nodeid, key, value):
         """
         Método RPC para `refresh`.  Actualiza el valor asociado con una clave en otro nodo.
         """
@@ -70,10 +152,26 @@ class KademliaProtocol(RPCProtocol):
 
         log.debug("got a refresh store request from %s, storing '%s'='%s'",
                 sender, key, value)
-        self.storage.set(key, value)
+        await self.run_storage(self.storage.set, key, value)
+        self.republish.received(key)
+        return True
+
+    async def rpc_refresh_many(self, sender, nodeid, items):
+        """
+        Método RPC para `refresh_many`. Como `refresh`, pero para varios pares
+        [clave, (marca de tiempo, valor)] en una sola escritura.
+        """
+        source = Node(nodeid, sender[0], sender[1])
+        self.welcome_if_new(source)
+
+        log.debug("got a refresh_many request from %s with %i keys",
+                sender, len(items))
+        await self.run_storage(self.storage.set_many, items)
+        for key, _ in items:
+            self.republish.received(key)
         return True
 
-    def rpc_store(self, sender, nodeid, key, value):
+    async def rpc_store(self, sender, nodeid, key, value):
         """
         Método RPC para `store`. Almacena un valor en otro nodo.
         """
@@ -82,35 +180,59 @@ class KademliaProtocol(RPCProtocol):
 
         log.debug("got a store request from %s, storing '%s'='%s'",
                 sender, key, value)
-        self.storage[key] = value
+        await self.run_storage(self.storage.__setitem__, key, value)
+        self.republish.received(key)
         
         return True
 
+    async def rpc_store_many(self, sender, nodeid, items):
+        """
+        Método RPC para `store_many`. Almacena varios pares [clave, valor] con una sola escritura.
+        """
+        source = Node(nodeid, sender[0], sender[1])
+        self.welcome_if_new(source)
+
+        log.debug("got a store_many request from %s with %i keys",
+                sender, len(items))
+        now = time.monotonic()
+        entries = [(key, (now, value)) for key, value in items]
+        await self.run_storage(self.storage.set_many, entries, keep_newer=False)
+        for key, _ in items:
+            self.republish.received(key)
+        return True
+
     def rpc_find_node(self, sender, nodeid, key):
         """
         Método RPC para `find_node`. Encuentra los vecinos más cercanos a una clave.
         """
-        log.info("finding neighbors of %i in local table",
-                int(nodeid, 16))
         source = Node(nodeid, sender[0], sender[1])
+        log.info("finding neighbors of %i in local table", source.long_id)
         self.welcome_if_new(source)
         node = Node(key)
         neighbors = self.router.find_neighbors(node, exclude=source)
     
-        return list(map(tuple, neighbors))
+        return pack_nodes(neighbors)
 
-    def rpc_find_value(self, sender, nodeid, key):
+    async def rpc_find_value(self, sender, nodeid, key):
         """
         Método RPC para `find_value`. Encuentra el valor asociado con una clave.
         """
         source = Node(nodeid, sender[0], sender[1])
         self.welcome_if_new(source)
-        value = self.storage.get(key, None)
+        value = await self.storage_get(key, None)
         if value is None:
             return self.rpc_find_node(sender, nodeid, key)
         
         return {'value': value}
 
+    async def rpc_find_values(self, sender, nodeid, keys):
+        """
+        Método RPC para `find_values`. Devuelve las entradas almacenadas de varias claves.
+        """
+        source = Node(nodeid, sender[0], sender[1])
+        self.welcome_if_new(source)
+        return {'values': await self.run_storage(self.storage.get_many, keys)}
+
     #Metodos asincronos para llamar a otros metodos
     async def call_find_node(self, node_to_ask, node_to_find):
         
@@ -122,8 +244,9 @@ class KademliaProtocol(RPCProtocol):
     async def call_find_value(self, node_to_ask, node_to_find):
         
         address = (node_to_ask.ip, node_to_ask.port)
+        # Las claves del almacenamiento son los SHA1 en hexadecimal
         result = await self.find_value(address, self.source_node.id,
-                                    node_to_find.id)
+                                    node_to_find.id.hex())
         
         return self.handle_call_response(result, node_to_ask)
 
@@ -139,6 +262,40 @@ class KademliaProtocol(RPCProtocol):
         
         return self.handle_call_response(result, node_to_ask)
     
+    async def call_store_many(self, node_to_ask, items):
+        """
+        Almacena varios pares (clave, valor) en un nodo, en tantos mensajes
+        como hagan falta para respetar el tamaño maximo de un RPC.
+        """
+        address = (node_to_ask.ip, node_to_ask.port)
+        results = []
+        for chunk in chunk_items([list(item) for item in items]):
+            result = await self.store_many(address, self.source_node.id, chunk)
+            results.append(self.handle_call_response(result, node_to_ask))
+            if not result[0]:
+                break
+        return all(result[0] for result in results)
+
+    async def call_refresh_many(self, node_to_ask, items):
+        """
+        Envia a un nodo varias entradas (clave, (marca de tiempo, valor)) para
+        que actualice las que tenga mas viejas, en tantos mensajes como haga falta.
+        """
+        address = (node_to_ask.ip, node_to_ask.port)
+        results = []
+        for chunk in chunk_items([[key, list(entry)] for key, entry in items]):
+            result = await self.refresh_many(address, self.source_node.id, chunk)
+            results.append(self.handle_call_response(result, node_to_ask))
+            if not result[0]:
+                break
+        return all(result[0] for result in results)
+
+    async def call_find_values(self, node_to_ask, keys):
+        address = (node_to_ask.ip, node_to_ask.port)
+        result = await self.find_values(address, self.source_node.id, list(keys))
+
+        return self.handle_call_response(result, node_to_ask)
+
     async def call_refresh(self, node_to_ask, key, value):
         address = (node_to_ask.ip, node_to_ask.port)
         result = await self.refresh(address, self.source_node.id, key, value)
@@ -165,12 +322,23 @@ class KademliaProtocol(RPCProtocol):
             return
 
         log.info("never seen %s before, adding to router", node)
-        log.debug("%s elements in storage of node %s", len(self.storage), self.source_node.long_id)
-        for key, value in self.storage:
+        asyncio.ensure_future(self._handoff(node))
+        self.router.add_contact(node)
+
+    async def _handoff(self, node):
+        """
+        Envia al nodo nuevo las claves que debe almacenar (ver welcome_if_new).
+        El almacenamiento se recorre en el hilo de entrada/salida; el nodo nuevo
+        se excluye de los vecinos porque ya fue agregado a la tabla.
+        """
+        items = await self.run_storage(list, self.storage)
+        log.debug("%s elements in storage of node %s", len(items), self.source_node.long_id)
+        handoff = []
+        for key, value in items:
             
             log.info("Element in storage: %s %s", key, value)
-            keynode = Node(digest(key))
-            neighbors = self.router.find_neighbors(keynode)
+            keynode = Node(key)
+            neighbors = self.router.find_neighbors(keynode, exclude=node)
             log.info("NEIGHBOURS %s", neighbors)
             
             if neighbors:
@@ -182,9 +350,10 @@ class KademliaProtocol(RPCProtocol):
                 log.info("THIS CLOSEST %s", this_closest)
             
             if not neighbors or (new_node_close and this_closest):
-                asyncio.ensure_future(self.call_store(node, key, value))
-        
-        self.router.add_contact(node)
+                handoff.append((key, value))
+
+        if handoff:
+            await self.call_store_many(node, handoff)
 
     def handle_call_response(self, result, node):
         """
@@ -0,0 +1,104 @@
+"""
+Planificacion de la republicacion de claves.
+"""
+import heapq
+import random
+import time
+
+
+class RepublishSchedule:
+    """
+    Guarda para cada clave el momento en que debe republicarse, como propone
+    el paper de Kademlia: el publicador original republica cada
+    `publisher_interval` segundos y las replicas cada `replica_interval`. Si un
+    nodo recibe la clave de otro par antes de su plazo, no necesita republicarla
+    y el plazo se pospone.
+
+    Los plazos se guardan en un min-heap con borrado perezoso.
+    """
+
+    def __init__(self, replica_interval=3600, publisher_interval=86400,
+                 max_per_cycle=64):
+        """
+        Args:
+            replica_interval (int): Segundos entre republicaciones de una replica.
+            publisher_interval (int): Segundos entre republicaciones del publicador original.
+            max_per_cycle (int): Cantidad maxima de claves republicadas en cada ciclo.
+        """
+        self.replica_interval = replica_interval
+        self.publisher_interval = publisher_interval
+        self.max_per_cycle = max_per_cycle
+        self.heap = []
+        self.deadlines = {}
+        self.publisher = set()
+
+    def _schedule(self, key, delay):
+        deadline = time.monotonic() + delay
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(d, k) for k, d in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def _interval(self, key):
+        if key in self.publisher:
+            return self.publisher_interval
+        return self.replica_interval
+
+    def published(self, key):
+        """
+        Este nodo acaba de publicar la clave: es su publicador original.
+        """
+        self.publisher.add(key)
+        self._schedule(key, self.publisher_interval)
+
+    def received(self, key):
+        """
+        Se recibio la clave de otro nodo: su republicacion puede esperar otro intervalo.
+        """
+        if key not in self.publisher:
+            self._schedule(key, self.replica_interval)
+
+    def track(self, key):
+        """
+        Empieza a seguir una clave ya almacenada (por ejemplo, al reiniciar el
+        nodo). El primer plazo se elige al azar para repartir la carga.
+        """
+        if key not in self.deadlines:
+            self._schedule(key, random.uniform(0, self.replica_interval))
+
+    def republished(self, key):
+        """
+        La clave se acaba de republicar: se programa el siguiente plazo.
+        """
+        self._schedule(key, self._interval(key))
+
+    def discard(self, key):
+        """
+        Deja de seguir una clave (por ejemplo, porque caduco).
+        """
+        self.deadlines.pop(key, None)
+        self.publisher.discard(key)
+
+    def due(self, limit=None):
+        """
+        Extrae las claves cuyo plazo ya vencio, como mucho `limit` (por defecto
+        max_per_cycle). Las que no entren quedan pendientes para el siguiente ciclo.
+        """
+        limit = self.max_per_cycle if limit is None else limit
+        now = time.monotonic()
+        keys = []
+        while self.heap and len(keys) < limit:
+            deadline, key = self.heap[0]
+            if self.deadlines.get(key) != deadline:
+                heapq.heappop(self.heap)
+                continue
+            if deadline > now:
+                break
+            heapq.heappop(self.heap)
+            del self.deadlines[key]
+            keys.append(key)
+        return keys
+
+    def __len__(self):
+        return len(self.deadlines)
@@ -1,11 +1,13 @@
+import bisect
 import heapq
 import time
-import operator
 import asyncio
 import logging
 
 from itertools import chain
 from collections import OrderedDict
+from kademlia import nodearray
+from kademlia.nodearray import NodeArray
 from kademlia.utils import shared_prefix, bytes_to_bit_string
 
 log = logging.getLogger(__name__)
@@ -15,7 +17,8 @@ class KBucket:
     Representa un bucket en la tabla de enrutamiento.
     """
 
-    def __init__(self, rangeLower, rangeUpper, ksize, replacementNodeFactor=5):
+    def __init__(self, rangeLower, rangeUpper, ksize, replacementNodeFactor=5,
+                 index=None):
         """
         Crea una nueva instancia de `KBucket`.
 
@@ -24,8 +27,11 @@ class KBucket:
             rangeUpper: El límite superior del rango del bucket.
             ksize: El valor de k para el número máximo de nodos en el bucket.
             replacementNodeFactor: El factor de multiplicación para el número máximo de nodos de reemplazo.
+            index: Un :class:`~kademlia.nodearray.NodeArray` donde se reflejan
+                   los nodos activos del bucket (opcional).
         """
         self.range = (rangeLower, rangeUpper)
+        self.index = index
         self.nodes = OrderedDict()
         self.replacement_nodes = OrderedDict()
         self.touch_last_updated()
@@ -49,8 +55,8 @@ class KBucket:
         Divide el bucket en dos buckets más pequeños.
         """
         midpoint = (self.range[0] + self.range[1]) // 2
-        one = KBucket(self.range[0], midpoint, self.ksize)
-        two = KBucket(midpoint + 1, self.range[1], self.ksize)
+        one = KBucket(self.range[0], midpoint, self.ksize, index=self.index)
+        two = KBucket(midpoint + 1, self.range[1], self.ksize, index=self.index)
         nodes = chain(self.nodes.values(), self.replacement_nodes.values())
         
         for node in nodes:
@@ -67,11 +73,15 @@ class KBucket:
             del self.replacement_nodes[node.id]
 
         if node.id in self.nodes:
-            del self.nodes[node.id]
+            removed = self.nodes.pop(node.id)
+            if self.index is not None:
+                self.index.discard(removed)
 
             if self.replacement_nodes:
                 newnode_id, newnode = self.replacement_nodes.popitem()
                 self.nodes[newnode_id] = newnode
+                if self.index is not None:
+                    self.index.add(newnode)
 
     def has_in_range(self, node):
         """
@@ -110,6 +120,8 @@ class KBucket:
             while len(self.replacement_nodes) > self.max_replacement_nodes:
                 self.replacement_nodes.popitem(last=False)
             return False
+        if self.index is not None:
+            self.index.add(node)
         return True
 
     def depth(self):
@@ -146,6 +158,10 @@ class RoutingTable:
     """
     Gestiona la tabla de enrutamiento de un nodo Kademlia.
     """
+
+    # Con numpy y al menos esta cantidad de contactos, find_neighbors ordena
+    # todos los contactos en bloque con un NodeArray
+    index_threshold = 1024
     def __init__(self, protocol, ksize, node):
         """
         Inicializa la tabla de enrutamiento.
@@ -164,7 +180,12 @@ class RoutingTable:
         """
         Limpia la tabla de enrutamiento.
         """
-        self.buckets = [KBucket(0, 2 ** 160, self.ksize)]
+        self.index = NodeArray() if nodearray.numpy is not None else None
+        self.buckets = [KBucket(0, 2 ** 160, self.ksize, index=self.index)]
+        # Limites superiores de los buckets, ordenados, para buscar con bisect
+        self.bounds = [bucket.range[1] for bucket in self.buckets]
+        # Limite inferior y bits libres de cada bucket (ver bucket_span)
+        self.spans = [bucket_span(bucket) for bucket in self.buckets]
 
     def split_bucket(self, index):
         """
@@ -173,6 +194,10 @@ class RoutingTable:
         one, two = self.buckets[index].split()
         self.buckets[index] = one
         self.buckets.insert(index + 1, two)
+        self.bounds[index] = one.range[1]
+        self.bounds.insert(index + 1, two.range[1])
+        self.spans[index] = bucket_span(one)
+        self.spans.insert(index + 1, bucket_span(two))
 
     def lonely_buckets(self):
         """
@@ -213,67 +238,82 @@ class RoutingTable:
 
     def get_bucket_for(self, node):
         """
-        Obtiene el índice del bucket al que pertenece un nodo dado.
+        Obtiene el índice del bucket al que pertenece un nodo dado: el primero
+        cuyo límite superior es mayor que su ID, por búsqueda binaria.
         """
-        for index, bucket in enumerate(self.buckets):
-            if node.long_id < bucket.range[1]:
-                return index
-        return None
+        index = bisect.bisect_right(self.bounds, node.long_id)
+        if index == len(self.bounds):
+            return None
+        return index
 
     def find_neighbors(self, node, k=None, exclude=None):
         """
         Encuentra los k nodos más cercanos a un nodo dado.
+
+        Los buckets se recorren en orden de la menor distancia XOR posible
+        entre el nodo y su rango, y la búsqueda se detiene cuando ningún
+        bucket restante puede contener un nodo más cercano que el k-ésimo
+        encontrado, de modo que el resultado son los k más cercanos exactos.
         """
         k = k or self.ksize
-        nodes = []
-        for neighbor in TableTraverser(self, node):
-            notexcluded = exclude is None or not neighbor.same_home_as(exclude)
-            if neighbor.id != node.id and notexcluded:
-                heapq.heappush(nodes, (node.distance_to(neighbor), neighbor))
-            if len(nodes) == k:
+        index = self.get_bucket_for(node)
+        if index is not None:
+            self.buckets[index].touch_last_updated()
+
+        if self.index is not None and len(self.index) >= self.index_threshold:
+            return self._find_neighbors_indexed(node, k, exclude)
+
+        target = node.long_id
+        order = [(((target ^ lower) >> free) << free, i)
+                 for i, (lower, free) in enumerate(self.spans)]
+        heapq.heapify(order)
+
+        # Max-heap (distancias negadas) con los k mejores hasta ahora
+        nearest = []
+        while order:
+            bound, i = heapq.heappop(order)
+            if len(nearest) == k and bound > -nearest[0][0]:
                 break
-
-        return list(map(operator.itemgetter(1), heapq.nsmallest(k, nodes)))
+            for neighbor in self.buckets[i].nodes.values():
+                distance = target ^ neighbor.long_id
+                full = len(nearest) == k
+                if full and distance >= -nearest[0][0]:
+                    continue
+                if neighbor.id == node.id:
+                    continue
+                if exclude is not None and neighbor.same_home_as(exclude):
+                    continue
+                entry = (-distance, id(neighbor), neighbor)
+                if full:
+                    heapq.heapreplace(nearest, entry)
+                else:
+                    heapq.heappush(nearest, entry)
+
+        nearest.sort(reverse=True)
+        return [neighbor for _, _, neighbor in nearest]
     
     
-class TableTraverser:
-    """
-    Iterador para recorrer la tabla de enrutamiento.
-    """
-    def __init__(self, table : RoutingTable, startNode):
-        """
-        Inicializa el iterador.
-
-        Args:
-            table: La tabla de enrutamiento.
-            startNode: El nodo de inicio para la búsqueda.
-        """ 
-        index = table.get_bucket_for(startNode)
-        table.buckets[index].touch_last_updated()
-        self.current_nodes = table.buckets[index].get_nodes()
-        self.left_buckets = table.buckets[:index]
-        self.right_buckets = table.buckets[(index + 1):]
-        self.left = True
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
+    def _find_neighbors_indexed(self, node, k, exclude):
         """
-        Devuelve el siguiente nodo de la tabla de enrutamiento.
+        find_neighbors sobre el NodeArray: pide unos pocos nodos de mas para
+        poder descartar el propio nodo y el excluido.
         """
-        if self.current_nodes:
-            return self.current_nodes.pop()
+        wanted = k + 2
+        while True:
+            found = self.index.closest(node.long_id, wanted)
+            neighbors = [n for n in found if n.id != node.id
+                         and (exclude is None or not n.same_home_as(exclude))]
+            if len(neighbors) >= k or len(found) < wanted:
+                return neighbors[:k]
+            wanted *= 2
 
-        if self.left and self.left_buckets:
-            self.current_nodes = self.left_buckets.pop().get_nodes()
-            self.left = False
-            return next(self)
-
-        if self.right_buckets:
-            self.current_nodes = self.right_buckets.pop(0).get_nodes()
-            self.left = True
-            return next(self)
-
-        raise StopIteration
 
+def bucket_span(bucket):
+    """
+    Devuelve (limite inferior, bits libres) del rango de un bucket. Los bits
+    por encima de los libres son comunes a todo el rango, asi que
+    ((target ^ inferior) >> libres) << libres es una cota inferior de la
+    distancia XOR entre `target` y cualquier ID del bucket.
+    """
+    lower, upper = bucket.range
+    return lower, (lower ^ upper).bit_length()
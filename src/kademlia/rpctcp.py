@@ -0,0 +1,229 @@
+"""
+Transporte por flujo (TCP) para las llamadas RPC grandes.
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+from base64 import b64encode
+from hashlib import sha1
+
+import umsgpack
+
+LOG = logging.getLogger(__name__)
+
+# Longitud de cada trama
+FRAME = struct.Struct('>I')
+
+
+class StreamConnection:
+    """
+    Una conexion saliente con un par. Lleva muchas solicitudes en curso a la
+    vez, distinguidas por su id de mensaje.
+    """
+
+    def __init__(self, address, reader, writer):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.outstanding = {}
+        self.last_used = time.monotonic()
+        self.task = None
+
+    def close(self):
+        self.writer.close()
+        for future in self.outstanding.values():
+            if not future.done():
+                future.set_result((False, None))
+        self.outstanding.clear()
+
+
+class RPCStream:
+    """
+    Transporte TCP para un :class:`~kademlia.rpcudp.RPCProtocol`, pensado para
+    las transferencias grandes (traspaso de claves, republicacion, valores
+    grandes). Las busquedas pequeñas siguen yendo por UDP.
+
+    Escucha en el mismo numero de puerto que el socket UDP. Cada trama es su
+    longitud (4 bytes) seguida de un mensaje con el mismo formato que un
+    datagrama: tipo, id de 20 bytes y msgpack. La primera trama de una conexion
+    es un saludo con el puerto UDP de quien la abre, para que los metodos rpc_*
+    reciban la direccion del remitente en la red Kademlia.
+
+    Se mantiene una conexion persistente por par, que se cierra tras
+    `idle_timeout` segundos sin uso.
+    """
+
+    def __init__(self, protocol, idle_timeout=60, connect_timeout=1,
+                 max_frame_size=64 << 20):
+        """
+        Args:
+            protocol: El RPCProtocol cuyos metodos rpc_* se atienden.
+            idle_timeout (int): Segundos sin uso tras los que se cierra una conexion.
+            connect_timeout (int): Tiempo maximo para abrir una conexion.
+            max_frame_size (int): Tamaño maximo de una trama.
+        """
+        self.protocol = protocol
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.max_frame_size = max_frame_size
+        self.port = None
+        self.server = None
+        self.evict_loop = None
+        self._connections = {}
+        self._connecting = {}
+        self._unreachable = {}
+
+    async def listen(self, port, interface='0.0.0.0'):
+        self.port = port
+        self.server = await asyncio.start_server(self._handle_peer,
+                                                 interface, port)
+        self.evict_idle()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+        if self.evict_loop:
+            self.evict_loop.cancel()
+        for conn in list(self._connections.values()):
+            self._drop(conn)
+
+    def evict_idle(self):
+        """
+        Cierra las conexiones sin solicitudes en curso que llevan
+        `idle_timeout` segundos sin usarse.
+        """
+        now = time.monotonic()
+        for conn in list(self._connections.values()):
+            if not conn.outstanding and now - conn.last_used > self.idle_timeout:
+                LOG.debug("closing idle stream to %s", conn.address)
+                self._drop(conn)
+        loop = asyncio.get_event_loop()
+        self.evict_loop = loop.call_later(self.idle_timeout, self.evict_idle)
+
+    def _drop(self, conn):
+        if self._connections.get(conn.address) is conn:
+            del self._connections[conn.address]
+        conn.close()
+        if conn.task is not None:
+            conn.task.cancel()
+
+    async def _read_frame(self, reader):
+        header = await reader.readexactly(FRAME.size)
+        size, = FRAME.unpack(header)
+        if size > self.max_frame_size:
+            raise ValueError("frame of %i bytes exceeds the limit" % size)
+        return await reader.readexactly(size)
+
+    @staticmethod
+    def _write_frame(writer, message):
+        writer.write(FRAME.pack(len(message)) + message)
+
+    async def call(self, address, data, timeout=None):
+        """
+        Envia una llamada ya empaquetada al par `address`. Devuelve
+        (True, respuesta), (False, None) si no hubo respuesta, o None si no
+        se pudo conectar con el par.
+        """
+        conn = await self._connection(address)
+        if conn is None:
+            return None
+
+        msg_id = sha1(os.urandom(32)).digest()
+        future = asyncio.get_event_loop().create_future()
+        conn.outstanding[msg_id] = future
+        conn.last_used = time.monotonic()
+        LOG.debug("calling remote function over stream on %s (msgid %s)",
+                  address, b64encode(msg_id))
+        self._write_frame(conn.writer, b'\x00' + msg_id + data)
+        try:
+            await conn.writer.drain()
+            timeout = self.protocol._wait_timeout if timeout is None else timeout
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            LOG.error("Did not receive reply for msg id %s from %s over stream",
+                      b64encode(msg_id), address)
+            return (False, None)
+        finally:
+            conn.outstanding.pop(msg_id, None)
+            conn.last_used = time.monotonic()
+
+    async def _connection(self, address):
+        """
+        Devuelve la conexion con `address`, abriendola si hace falta. Los pares
+        que rechazaron la conexion no se vuelven a intentar durante `idle_timeout`.
+        """
+        conn = self._connections.get(address)
+        if conn is not None:
+            return conn
+        failed = self._unreachable.get(address)
+        if failed is not None and time.monotonic() - failed < self.idle_timeout:
+            return None
+
+        if address not in self._connecting:
+            self._connecting[address] = asyncio.ensure_future(self._connect(address))
+        try:
+            return await asyncio.shield(self._connecting[address])
+        finally:
+            self._connecting.pop(address, None)
+
+    async def _connect(self, address):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(*address), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            LOG.debug("could not open stream to %s: %s", address, e)
+            self._unreachable[address] = time.monotonic()
+            return None
+
+        self._unreachable.pop(address, None)
+        conn = StreamConnection(address, reader, writer)
+        self._write_frame(writer, umsgpack.packb(self.port))
+        conn.task = asyncio.ensure_future(self._read_responses(conn))
+        self._connections[address] = conn
+        return conn
+
+    async def _read_responses(self, conn):
+        try:
+            while True:
+                message = await self._read_frame(conn.reader)
+                msg_id, data = message[1:21], umsgpack.unpackb(message[21:])
+                future = conn.outstanding.get(msg_id)
+                if future is None or future.done():
+                    LOG.warning("received unknown message %s from %s over "
+                                "stream; ignoring", b64encode(msg_id), conn.address)
+                    continue
+                future.set_result((True, data))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            LOG.debug("stream to %s closed: %s", conn.address, e)
+        finally:
+            conn.task = None
+            self._drop(conn)
+
+    async def _handle_peer(self, reader, writer):
+        """
+        Atiende una conexion entrante: lee el saludo y luego ejecuta cada
+        solicitud recibida, respondiendo por la misma conexion.
+        """
+        try:
+            port = umsgpack.unpackb(await self._read_frame(reader))
+            address = (writer.get_extra_info('peername')[0], port)
+            while True:
+                message = await self._read_frame(reader)
+                if message[:1] != b'\x00':
+                    continue
+                asyncio.ensure_future(self._answer(writer, address,
+                                                   message[1:21],
+                                                   umsgpack.unpackb(message[21:])))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            LOG.debug("incoming stream closed: %s", e)
+        finally:
+            writer.close()
+
+    async def _answer(self, writer, address, msg_id, data):
+        found, response = await self.protocol._dispatch(data, address)
+        if not found or writer.is_closing():
+            return
+        self._write_frame(writer, b'\x01' + msg_id + umsgpack.packb(response))
+        await writer.drain()
@@ -1,13 +1,32 @@
 import asyncio
 import logging
 import os
+import struct
+import time
+import zlib
+from collections import deque
 from base64 import b64encode
 from hashlib import sha1
 
 import umsgpack
 
+from kademlia.utils import COMPRESSED_VALUE
+
 LOG = logging.getLogger(__name__)
 
+# Indice y total de fragmentos de un mensaje fragmentado
+FRAGMENT = struct.Struct('>HH')
+
+# Bits altos del byte de tipo: mensaje comprimido con zlib y remitente que
+# acepta mensajes comprimidos. Solo se usan con pares que enviaron un saludo
+# (HELLO), para que los nodos anteriores sigan entendiendo cada RPC.
+COMPRESSED = 0x80
+ACCEPTS_COMPRESSION = 0x40
+
+# Tipo del datagrama con el que un nodo anuncia que entiende esos bits; los
+# nodos anteriores lo ignoran como un mensaje desconocido
+HELLO = 0x05
+
 
 class MalformedMessage(Exception):
     """
@@ -19,18 +38,69 @@ class RPCProtocol(asyncio.DatagramProtocol):
     """
     Implementación del protocolo usando msgpack para codificar mensajes y asyncio
     para manejar el envío y la recepción asíncronos.
+
+    Si se le asigna un transporte de flujo (`stream`, ver
+    :class:`~kademlia.rpctcp.RPCStream`), las llamadas de `bulk_rpcs` y las
+    mayores que `stream_threshold` bytes se envian por el.
     """
 
-    def __init__(self, wait_timeout=5):
+    # Llamadas que se envian por el transporte de flujo, si lo hay
+    bulk_rpcs = frozenset()
+    stream_threshold = 8192
+
+    def __init__(self, wait_timeout=5, min_timeout=0.2, initial_timeout=1,
+                 retransmit=True, batch_size=1400, max_message_size=1 << 20,
+                 max_reassembly_bytes=8 << 20, max_partials=256,
+                 nack_delay=0.05, compress_threshold=1024):
         """
         Crea una instancia de protocolo.
 
+        El tiempo de espera de cada llamada se calcula a partir del RTT medido
+        con cada par, como el RTO de TCP (RFC 6298). A los pares de los que aun
+        no hay medidas se les espera `initial_timeout`. Entre la primera espera
+        y la del reenvio no se pasa de `wait_timeout` (salvo `min_timeout`).
+
         Args:
-            wait_timeout (int): Tiempo de espera para una respuesta antes de darse por vencido.
+            wait_timeout (int): Tiempo de espera maximo para una respuesta antes de darse por vencido.
+            min_timeout (float): Tiempo de espera minimo, aunque el RTT medido sea menor.
+            initial_timeout (float): Tiempo de espera para un par sin RTT medido.
+            retransmit (bool): Si es True, una solicitud sin respuesta se reenvia
+                               una vez (esperando el doble) antes de darla por fallida.
+            batch_size (int): Tamaño maximo de un datagrama que agrupa varios
+                              mensajes para el mismo destino. Los mensajes mas
+                              grandes se envian fragmentados.
+            max_message_size (int): Tamaño maximo de una llamada o respuesta.
+            max_reassembly_bytes (int): Memoria maxima ocupada por mensajes
+                                        recibidos a medias.
+            max_partials (int): Cantidad maxima de mensajes recibidos a medias.
+            nack_delay (float): Segundos sin recibir fragmentos de un mensaje
+                                incompleto antes de pedir los que faltan.
+            compress_threshold (int): Los mensajes mayores se comprimen con zlib
+                                      si el destino anuncio que lo acepta. Con
+                                      None no se comprime ni se anuncia.
         """
         self._wait_timeout = wait_timeout
+        self.min_timeout = min_timeout
+        self._initial_timeout = initial_timeout
+        self._retransmit = retransmit
         self._outstanding = {}
+        self._rtt = {}
+        self._rtt_samples = deque(maxlen=256)
+        self._batch_size = batch_size
+        self._batches = {}
+        self._flush_handle = None
+        self._max_message_size = max_message_size
+        self._max_reassembly_bytes = max_reassembly_bytes
+        self._max_partials = max_partials
+        self._nack_delay = nack_delay
+        self._fragments_sent = {}
+        self._partials = {}
+        self._partial_bytes = 0
+        self._compress_threshold = compress_threshold
+        self._compress_peers = set()
+        self._hello_sent = set()
         self.transport = None
+        self.stream = None
 
     def connection_made(self, transport):
         """
@@ -45,21 +115,253 @@ class RPCProtocol(asyncio.DatagramProtocol):
         LOG.debug("received datagram from %s", addr)
         asyncio.ensure_future(self._solve_datagram(data, addr))
 
+    def _send(self, txdata, address):
+        """
+        Encola un mensaje para `address`. Los mensajes encolados durante la
+        misma vuelta del event loop se envian juntos en un solo datagrama
+        (de tipo 0x02), sin superar `batch_size` bytes.
+        """
+        if len(txdata) > self._batch_size:
+            self._send_fragments(txdata, address)
+            return
+
+        batch = self._batches.setdefault(address, [])
+        if sum(map(len, batch)) + len(txdata) > self._batch_size:
+            self._send_batch(batch, address)
+            batch.clear()
+        batch.append(txdata)
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_soon(self._flush)
+
+    def _flush(self):
+        """
+        Envia todos los mensajes encolados, un datagrama por destino.
+        """
+        self._flush_handle = None
+        batches, self._batches = self._batches, {}
+        for address, batch in batches.items():
+            self._send_batch(batch, address)
+
+    def _send_batch(self, batch, address):
+        if len(batch) == 1:
+            self.transport.sendto(batch[0], address)
+        elif batch:
+            LOG.debug("sending %i messages in one datagram to %s",
+                      len(batch), address)
+            self.transport.sendto(b'\x02' + umsgpack.packb(batch), address)
+
+    def _send_fragments(self, txdata, address):
+        """
+        Envia un mensaje mayor que `batch_size` en fragmentos de tipo 0x03.
+        Cada fragmento lleva la cabecera del mensaje (tipo e id), su indice y
+        el total. Los fragmentos se guardan `wait_timeout` segundos por si el
+        destino pide los que le falten (ver _accept_nack).
+        """
+        prefix, body = txdata[:21], txdata[21:]
+        size = self._batch_size - 22 - FRAGMENT.size
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        fragments = [b'\x03' + prefix + FRAGMENT.pack(index, len(chunks)) + chunk
+                     for index, chunk in enumerate(chunks)]
+
+        key = (address, prefix)
+        if key in self._fragments_sent:
+            self._fragments_sent[key][1].cancel()
+        loop = asyncio.get_event_loop()
+        expire = loop.call_later(self._wait_timeout,
+                                 self._fragments_sent.pop, key, None)
+        self._fragments_sent[key] = (fragments, expire)
+
+        LOG.debug("sending %i bytes in %i fragments to %s",
+                  len(txdata), len(fragments), address)
+        for fragment in fragments:
+            self.transport.sendto(fragment, address)
+
+    def _accept_fragment(self, datagram, address):
+        """
+        Guarda un fragmento recibido. Devuelve el mensaje completo cuando
+        llega el ultimo fragmento, o None mientras falten.
+        """
+        if len(datagram) <= 22 + FRAGMENT.size:
+            LOG.warning("received fragment too small from %s, ignoring", address)
+            return None
+        prefix = datagram[1:22]
+        index, count = FRAGMENT.unpack_from(datagram, 22)
+        chunk = datagram[22 + FRAGMENT.size:]
+        key = (address, prefix)
+        if index >= count:
+            LOG.warning("received fragment %i of %i from %s, ignoring",
+                        index, count, address)
+            return None
+
+        partial = self._partials.get(key)
+        if partial is None:
+            if count * len(chunk) > self._max_message_size:
+                LOG.warning("fragmented message from %s exceeds %i bytes, "
+                            "ignoring", address, self._max_message_size)
+                return None
+            while len(self._partials) >= self._max_partials:
+                oldest = next(iter(self._partials))
+                LOG.warning("too many partial messages, dropping the one "
+                            "from %s", oldest[0])
+                self._drop_partial(oldest)
+            partial = self._partials[key] = {'count': count, 'parts': {},
+                                             'size': 0, 'nacks': 0,
+                                             'timer': None}
+        parts = partial['parts']
+        if index >= partial['count'] or index in parts:
+            return None
+
+        parts[index] = chunk
+        partial['nacks'] = 0
+        partial['size'] += len(chunk)
+        self._partial_bytes += len(chunk)
+        if len(parts) == partial['count']:
+            self._drop_partial(key)
+            return prefix + b''.join(parts[i] for i in range(len(parts)))
+
+        if partial['timer'] is not None:
+            partial['timer'].cancel()
+        loop = asyncio.get_event_loop()
+        partial['timer'] = loop.call_later(self._nack_delay, self._nack, key)
+
+        # Si hay demasiados mensajes a medias se descartan los mas viejos
+        while self._partial_bytes > self._max_reassembly_bytes:
+            oldest = next(iter(self._partials))
+            LOG.warning("reassembly buffers full, dropping partial message "
+                        "from %s", oldest[0])
+            self._drop_partial(oldest)
+        return None
+
+    def _drop_partial(self, key):
+        partial = self._partials.pop(key)
+        self._partial_bytes -= partial['size']
+        if partial['timer'] is not None:
+            partial['timer'].cancel()
+
+    def _nack(self, key):
+        """
+        Pide al remitente los fragmentos que faltan de un mensaje (tipo 0x04).
+        Tras tres pedidos seguidos sin recibir nada, el mensaje se descarta.
+        """
+        partial = self._partials.get(key)
+        if partial is None:
+            return
+        address, prefix = key
+        if partial['nacks'] >= 3:
+            LOG.warning("could not reassemble message from %s, dropping it",
+                        address)
+            self._drop_partial(key)
+            return
+
+        missing = [i for i in range(partial['count'])
+                   if i not in partial['parts']]
+        LOG.debug("asking %s for %i missing fragments", address, len(missing))
+        self.transport.sendto(b'\x04' + prefix + umsgpack.packb(missing[:256]),
+                              address)
+        partial['nacks'] += 1
+        loop = asyncio.get_event_loop()
+        partial['timer'] = loop.call_later(self._nack_delay * 2 ** partial['nacks'],
+                                           self._nack, key)
+
+    def _accept_nack(self, datagram, address):
+        """
+        Reenvia los fragmentos que pide el destino de un mensaje fragmentado.
+        """
+        sent = self._fragments_sent.get((address, datagram[1:22]))
+        if sent is None:
+            return
+        fragments = sent[0]
+        for index in umsgpack.unpackb(datagram[22:]):
+            if 0 <= index < len(fragments):
+                self.transport.sendto(fragments[index], address)
+
+    def _frame(self, kind, msg_id, payload, address):
+        """
+        Arma un mensaje: byte de tipo con sus banderas, id y carga.
+
+        Las banderas solo se ponen si el destino saludó; a los demás se les
+        envía un saludo y el mensaje sale sin banderas. La carga se comprime si
+        supera `compress_threshold`, salvo que ya lleve un valor comprimido por
+        compress_value.
+        """
+        if self._compress_threshold is None:
+            return bytes([kind]) + msg_id + payload
+        if address not in self._compress_peers:
+            self._hello(address)
+            return bytes([kind]) + msg_id + payload
+
+        flags = ACCEPTS_COMPRESSION
+        if (len(payload) > self._compress_threshold
+                and COMPRESSED_VALUE not in payload):
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= COMPRESSED
+        return bytes([kind | flags]) + msg_id + payload
+
+    def _hello(self, address):
+        """
+        Anuncia a `address`, una sola vez, que este nodo entiende mensajes
+        comprimidos.
+        """
+        if address in self._hello_sent or self.transport is None:
+            return
+        self._hello_sent.add(address)
+        self.transport.sendto(bytes([HELLO]) + bytes(20) + umsgpack.packb(1),
+                              address)
+
+    def _payload(self, datagram, address):
+        """
+        Devuelve la carga de un mensaje, descomprimida si hace falta, y
+        recuerda si el remitente acepta mensajes comprimidos.
+        """
+        flags = datagram[0]
+        if flags & ACCEPTS_COMPRESSION:
+            self._compress_peers.add(address)
+        if not flags & COMPRESSED:
+            return datagram[21:]
+        decompressor = zlib.decompressobj()
+        payload = decompressor.decompress(datagram[21:], self._max_message_size)
+        if decompressor.unconsumed_tail:
+            raise MalformedMessage("Compressed message from %s exceeds %i bytes"
+                                   % (address, self._max_message_size))
+        return payload
+
     async def _solve_datagram(self, datagram, address):
         """
         Procesa el datagrama recibido.
         """
+        if datagram[:1] == b'\x02':
+            for message in umsgpack.unpackb(datagram[1:]):
+                await self._solve_datagram(message, address)
+            return
+
+        if datagram[:1] == b'\x03':
+            datagram = self._accept_fragment(datagram, address)
+            if datagram is None:
+                return
+        elif datagram[:1] == b'\x04':
+            self._accept_nack(datagram, address)
+            return
+        elif datagram[:1] == bytes([HELLO]):
+            if self._compress_threshold is not None:
+                self._compress_peers.add(address)
+                self._hello(address)
+            return
+
         if len(datagram) < 22:
             LOG.warning("received datagram too small from %s,"
                         " ignoring", address)
             return
 
         msg_id = datagram[1:21]
-        data = umsgpack.unpackb(datagram[21:])
+        data = umsgpack.unpackb(self._payload(datagram, address))
+        kind = datagram[0] & ~(COMPRESSED | ACCEPTS_COMPRESSION)
 
-        if datagram[:1] == b'\x00':
+        if kind == 0x00:
             asyncio.ensure_future(self._accept_request(msg_id, data, address))
-        elif datagram[:1] == b'\x01':
+        elif kind == 0x01:
             self._accept_response(msg_id, data, address)
         else:
             LOG.debug("Received unknown message from %s, ignoring", address)
@@ -78,15 +380,67 @@ class RPCProtocol(asyncio.DatagramProtocol):
         LOG.debug("received response %s for message "
                   "id %s from %s", data, *msgargs)
         
-        future, timeout = self._outstanding[msg_id]
+        future, timeout, txdata, sent, retries = self._outstanding[msg_id]
         timeout.cancel()
+        # Algoritmo de Karn: las respuestas a solicitudes reenviadas no se miden
+        if retries == 0:
+            self._update_rtt(address, time.monotonic() - sent)
         future.set_result((True, data))
         del self._outstanding[msg_id]
 
+    def _update_rtt(self, address, rtt):
+        """
+        Actualiza el RTT suavizado y su variacion para un par (RFC 6298).
+        """
+        self._rtt_samples.append(rtt)
+        if address not in self._rtt:
+            self._rtt[address] = (rtt, rtt / 2)
+            return
+        srtt, rttvar = self._rtt[address]
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - rtt)
+        srtt = 0.875 * srtt + 0.125 * rtt
+        self._rtt[address] = (srtt, rttvar)
+
+    def rtt_percentile(self, p):
+        """
+        Percentil `p` (0-100) de los ultimos RTT medidos con cualquier par, o
+        None si todavia no hay medidas.
+        """
+        if not self._rtt_samples:
+            return None
+        samples = sorted(self._rtt_samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def rto(self, address):
+        """
+        Tiempo de espera para una solicitud a `address`: SRTT + 4 * RTTVAR,
+        acotado entre `min_timeout` y `wait_timeout`. Sin medidas del par se
+        usa `initial_timeout`.
+        """
+        if address not in self._rtt:
+            return min(self._wait_timeout, self._initial_timeout)
+        srtt, rttvar = self._rtt[address]
+        return min(self._wait_timeout, max(self.min_timeout, srtt + 4 * rttvar))
+
     async def _accept_request(self, msg_id, data, address):
         """
         Procesa una solicitud de otro nodo.
         """
+        found, response = await self._dispatch(data, address)
+        if not found:
+            return
+        
+        LOG.debug("sending response %s for msg id %s to %s",
+                response, b64encode(msg_id), address)
+        txdata = self._frame(0x01, msg_id, umsgpack.packb(response), address)
+        
+        self._send(txdata, address)
+
+    async def _dispatch(self, data, address):
+        """
+        Ejecuta el metodo rpc_* pedido en una solicitud. Devuelve la tupla
+        (True, respuesta), o (False, None) si el metodo no existe.
+        """
         if not isinstance(data, list) or len(data) != 2:
             raise MalformedMessage("Could not read packet: %s" % data)
         
@@ -97,31 +451,82 @@ class RPCProtocol(asyncio.DatagramProtocol):
             msgargs = (self.__class__.__name__, funcname)
             LOG.warning("%s has no callable method "
                         "rpc_%s; ignoring request", *msgargs)
-            return
+            return False, None
 
-        if not asyncio.iscoroutinefunction(func):
-            func = asyncio.coroutine(func)
-        response = await func(address, *args)
-        
-        LOG.debug("sending response %s for msg id %s to %s",
-                response, b64encode(msg_id), address)
-        txdata = b'\x01' + msg_id + umsgpack.packb(response)
-        
-        self.transport.sendto(txdata, address)
+        if asyncio.iscoroutinefunction(func):
+            return True, await func(address, *args)
+        return True, func(address, *args)
 
-    def _timeout(self, msg_id):
+    def _timeout(self, msg_id, address, wait):
         """
-        Se llama cuando se agota el tiempo de espera para una respuesta.
+        Se llama cuando se agota el tiempo de espera para una respuesta. Si
+        se permite, la solicitud se reenvia una vez esperando el doble, sin
+        que la espera total pase de `wait_timeout`.
         """
-        args = (b64encode(msg_id), self._wait_timeout)
+        future, _, txdata, sent, retries = self._outstanding[msg_id]
+        if self._retransmit and retries == 0:
+            LOG.debug("no reply for msg id %s within %.3f seconds, resending",
+                      b64encode(msg_id), wait)
+            self._send(txdata, address)
+            wait = min(2 * wait, max(self.min_timeout, self._wait_timeout - wait))
+            loop = asyncio.get_event_loop()
+            timeout = loop.call_later(wait, self._timeout, msg_id, address, wait)
+            self._outstanding[msg_id] = (future, timeout, txdata, sent, 1)
+            return
+
+        args = (b64encode(msg_id), wait)
         
         LOG.error("Did not receive reply for msg "
-                  "id %s within %i seconds", *args)
+                  "id %s within %.3f seconds", *args)
         
-        self._outstanding[msg_id][0].set_result((False, None))
+        future.set_result((False, None))
         
         del self._outstanding[msg_id]
 
+    def _call_datagram(self, address, name, data):
+        """
+        Envia una llamada ya empaquetada por UDP. Devuelve un futuro que se
+        resuelve con (True, respuesta) o (False, None) si no hubo respuesta.
+        """
+        if len(data) > self._max_message_size:
+            raise MalformedMessage("Total length of function name and "
+                                "arguments cannot exceed %i bytes"
+                                % self._max_message_size)
+        msg_id = sha1(os.urandom(32)).digest()
+        txdata = self._frame(0x00, msg_id, data, address)
+        LOG.debug("calling remote function %s on %s (msgid %s)",
+                name, address, b64encode(msg_id))
+        self._send(txdata, address)
+
+        loop = asyncio.get_event_loop()
+        if hasattr(loop, 'create_future'):
+            future = loop.create_future()
+        else:
+            future = asyncio.Future()
+        wait = self.rto(address)
+        if len(txdata) > self._batch_size:
+            # Tiempo para recuperar fragmentos perdidos antes de reenviar todo
+            wait = min(self._wait_timeout, wait + 4 * self._nack_delay)
+        timeout = loop.call_later(wait, self._timeout, msg_id, address, wait)
+        self._outstanding[msg_id] = (future, timeout, txdata,
+                                     time.monotonic(), 0)
+        return future
+
+    async def _call_stream(self, address, name, data):
+        """
+        Envia una llamada por el transporte de flujo. Si no se puede conectar
+        con el par, se envia por UDP.
+        """
+        result = await self.stream.call(address, data)
+        if result is not None:
+            return result
+        if len(data) > self._max_message_size:
+            LOG.warning("no stream to %s and %s is too large for UDP",
+                        address, name)
+            return (False, None)
+        LOG.debug("no stream to %s, sending %s over UDP", address, name)
+        return await self._call_datagram(address, name, data)
+
     def __getattr__(self, name):
         """
         Si el nombre comienza con "_" o "rpc_", devuelve el valor del
@@ -145,24 +550,11 @@ class RPCProtocol(asyncio.DatagramProtocol):
             pass
 
         def func(address, *args):
-            msg_id = sha1(os.urandom(32)).digest()
             data = umsgpack.packb([name, args])
-            if len(data) > 8192:
-                raise MalformedMessage("Total length of function "
-                                    "name and arguments cannot exceed 8K")
-            txdata = b'\x00' + msg_id + data
-            LOG.debug("calling remote function %s on %s (msgid %s)",
-                    name, address, b64encode(msg_id))
-            self.transport.sendto(txdata, address)
-
-            loop = asyncio.get_event_loop()
-            if hasattr(loop, 'create_future'):
-                future = loop.create_future()
-            else:
-                future = asyncio.Future()
-            timeout = loop.call_later(self._wait_timeout,
-                                    self._timeout, msg_id)
-            self._outstanding[msg_id] = (future, timeout)
-            return future
+            if self.stream is not None and (name in self.bulk_rpcs
+                                            or len(data) > self.stream_threshold):
+                return asyncio.ensure_future(
+                    self._call_stream(address, name, data))
+            return self._call_datagram(address, name, data)
 
         return func
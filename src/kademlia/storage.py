@@ -1,6 +1,13 @@
+import base64
+import functools
+import heapq
 import logging
+import os
+import sqlite3
+import struct
+import threading
 import time
-from itertools import takewhile
+import zlib
 import operator
 from collections import OrderedDict
 from abc import abstractmethod, ABC
@@ -10,25 +17,249 @@ import pickle
 
 log = logging.getLogger(__name__)  
 
+# Indica que una clave no puede resolverse solo con memoria
+NOT_CACHED = object()
+
+# dictdatabase guarda JSON: los valores en bytes (como los de compress_value)
+# se escriben en base85 tras este prefijo
+JSON_BYTES = '\x00b85:'
+
+
+def to_json(entry):
+    birthday, value = entry
+    if isinstance(value, bytes):
+        value = JSON_BYTES + base64.b85encode(value).decode('ascii')
+    return (birthday, value)
+
+
+def from_json(entry):
+    birthday, value = entry
+    if isinstance(value, str) and value.startswith(JSON_BYTES):
+        value = base64.b85decode(value[len(JSON_BYTES):])
+    return (birthday, value)
+
+
+def locked(method):
+    """
+    Ejecuta el metodo con el candado del almacenamiento tomado, para poder
+    usarlo tanto desde el event loop como desde el hilo de entrada/salida.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ExpiryHeap:
+    """
+    Indice de caducidad: un min-heap de (marca de tiempo, clave) con borrado
+    perezoso. Las entradas del heap que ya no coinciden con la marca de tiempo
+    actual de su clave se descartan al llegar a la cima.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.birthdays = {}
+
+    def push(self, key, birthday):
+        """
+        Registra (o actualiza) la marca de tiempo de una clave. Si ya tenia
+        esa misma marca no se hace nada, para no duplicar su entrada.
+        """
+        if self.birthdays.get(key) == birthday:
+            return
+        self.birthdays[key] = birthday
+        heapq.heappush(self.heap, (birthday, key))
+        if len(self.heap) > 2 * len(self.birthdays) + 64:
+            self.heap = [(b, k) for k, b in self.birthdays.items()]
+            heapq.heapify(self.heap)
+
+    def discard(self, key):
+        """
+        Deja de seguir una clave.
+        """
+        self.birthdays.pop(key, None)
+
+    def _clean_top(self):
+        while self.heap:
+            birthday, key = self.heap[0]
+            if self.birthdays.get(key) == birthday:
+                return
+            heapq.heappop(self.heap)
+
+    def _pop_older(self, min_birthday):
+        entries = []
+        self._clean_top()
+        while self.heap and self.heap[0][0] <= min_birthday:
+            entries.append(heapq.heappop(self.heap))
+            self._clean_top()
+        return entries
+
+    def pop_expired(self, min_birthday):
+        """
+        Extrae y devuelve las claves con marca de tiempo menor o igual a min_birthday.
+        """
+        expired = []
+        for birthday, key in self._pop_older(min_birthday):
+            # Una entrada repetida de una clave ya extraida se ignora
+            if self.birthdays.get(key) == birthday:
+                del self.birthdays[key]
+                expired.append(key)
+        return expired
+
+    def older_than(self, min_birthday):
+        """
+        Devuelve, sin extraerlas, las claves con marca de tiempo menor o igual a min_birthday.
+        """
+        keys, seen = [], set()
+        for birthday, key in self._pop_older(min_birthday):
+            if key in seen:
+                continue
+            seen.add(key)
+            keys.append(key)
+            heapq.heappush(self.heap, (birthday, key))
+        return keys
+
+    def __len__(self):
+        return len(self.birthdays)
+
+
 class Storage:
     """
     Almacenamiento local para este nodo.
     Las implementaciones de almacenamiento de get deben devolver el mismo tipo que el que se puso en set
+
+    Mantiene una cache LRU residente delante de la base de datos. Las escrituras
+    se marcan como sucias y se vuelcan a disco por lotes, al superar un umbral de
+    claves sucias o un intervalo de tiempo, o al llamar a flush.
     """
 
-    def __init__(self, file_name, ttl=604800):
+    # Sus operaciones pueden hacer entrada/salida y deben ejecutarse fuera del event loop
+    blocking = True
+
+    def __init__(self, file_name, ttl=604800, cache_size=4096,
+                 flush_interval=5, flush_threshold=64):
+        """
+        Args:
+            file_name: Nombre de la base de datos.
+            ttl (int): Tiempo de vida de las claves, en segundos.
+            cache_size (int): Cantidad maxima de claves residentes en memoria.
+            flush_interval (float): Segundos maximos que una escritura puede
+                                    permanecer sin volcarse a disco.
+            flush_threshold (int): Cantidad de claves sucias que provoca un volcado.
+        """
         self.file_name = file_name
         self.ttl = ttl
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._removed = set()
+        self._expiry = ExpiryHeap()
+        self._lock = threading.RLock()
+        self._last_flush = time.monotonic()
 
         DDB.config.storage_directory = "database"
 
         database = DDB.at(f"{self.file_name}")
         if not database.exists():
             database.create({})
+            self._complete = True
         else:
-            #database already exist, do nothing
-            pass
+            data = database.read()
+            # Si la base de datos cabe en la cache se carga completa y no hace
+            # falta volver a leer el disco para iterar o buscar claves ausentes
+            self._complete = len(data) <= self.cache_size
+            for key, entry in data.items():
+                self._expiry.push(key, entry[0])
+                if self._complete:
+                    self._cache[key] = from_json(entry)
+
+    def _load(self, key):
+        """
+        Obtiene la entrada (marca de tiempo, valor) de una clave, leyendo el
+        disco solo si la clave no esta en la cache.
+        """
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if self._complete or key in self._removed:
+            return None
+
+        entry = DDB.at(f"{self.file_name}", key=key).read()
+        if entry is None:
+            return None
+        entry = from_json(entry)
+        self._cache[key] = entry
+        self._evict()
+        return entry
+
+    def _put(self, key, entry, flush=True):
+        """
+        Guarda una entrada en la cache y la marca como sucia.
+        """
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        self._dirty.add(key)
+        self._removed.discard(key)
+        self._expiry.push(key, entry[0])
+
+        if flush:
+            self._maybe_flush()
+        self._evict()
+
+    def _maybe_flush(self):
+        """
+        Vuelca a disco si se alcanzo el umbral de claves sucias o el intervalo de volcado.
+        """
+        if (len(self._dirty) >= self.flush_threshold or
+                time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def _evict(self):
+        """
+        Descarta las entradas menos usadas recientemente cuando la cache
+        supera su tamaño. Las entradas sucias se vuelcan antes de descartarse.
+        """
+        while len(self._cache) > self.cache_size:
+            key = next(iter(self._cache))
+            if key in self._dirty:
+                self.flush()
+            del self._cache[key]
+            self._complete = False
+
+    @locked
+    def flush(self):
+        """
+        Vuelca a disco, en una sola sesion, todas las escrituras y borrados pendientes.
+        """
+        self._last_flush = time.monotonic()
+        if not self._dirty and not self._removed:
+            return
+
+        log.debug("Flushing %i keys to %s", len(self._dirty), self.file_name)
+        with DDB.at(f"{self.file_name}").session() as (session, file):
+            for key in self._dirty:
+                file[key] = to_json(self._cache[key])
+            for key in self._removed:
+                file.pop(key, None)
+            session.write()
+        self._dirty.clear()
+        self._removed.clear()
+
+    def _read_all(self):
+        """
+        Devuelve un diccionario con todas las entradas almacenadas.
+        """
+        if self._complete:
+            return self._cache
+        self.flush()
+        return {key: from_json(entry) for key, entry
+                in DDB.at(f"{self.file_name}").read().items()}
 
+    @locked
     def __setitem__(self, key, value):
         """
         Almacena un valor asociado con una clave en la base de datos.
@@ -36,27 +267,30 @@ class Storage:
         if value == None:
             pass
         else:
-            with DDB.at(f"{self.file_name}").session() as (session, file):
-                file[f"{key}"] = (time.monotonic(), value)
-                session.write()
+            self._put(f"{key}", (time.monotonic(), value))
 
+    @locked
     def cull(self):
         """
         Elimina las claves y valores que han caducado (más viejos que el TTL).
         """
-        with DDB.at(f"{self.file_name}").session() as (session, data):
-            print(self.iter_older_than(self.ttl))
-            for id, _ in self.iter_older_than(self.ttl):
-                del data[id]
-            session.write()
+        min_birthday = time.monotonic() - self.ttl
+        for key in self._expiry.pop_expired(min_birthday):
+            self._cache.pop(key, None)
+            self._dirty.discard(key)
+            self._removed.add(key)
+        self.flush()
 
+    @locked
     def __getitem__(self, key):
         """
         Obtiene el valor asociado con una clave. Lanza KeyError si la clave no existe.
         """
-        if DDB.at(f"{self.file_name}", key=f"{key}").exists():
-            return DDB.at(f"{self.file_name}", key=f"{key}").read()[1]
+        entry = self._load(f"{key}")
+        if entry is not None:
+            return entry[1]
 
+    @locked
     def set(self, key, value):
         """
         Almacena un valor asociado con una clave, actualizando la marca de tiempo si la clave ya existe.
@@ -64,80 +298,153 @@ class Storage:
         if value == None:
             pass
         else:
-            data = value
+            data = tuple(value)
             log.debug("New data %s", data)
-            if DDB.at(f"{self.file_name}", key=key).exists():
-                data_read = DDB.at(f"{self.file_name}", key=f"{key}").read()
+            data_read = self._load(f"{key}")
+            if data_read is not None:
                 log.debug("Data %s", data_read)
                 if value[0] < data_read[0]:
-                    data =data_read                  
+                    return
 
-            with DDB.at(f"{self.file_name}").session() as (session, file):
-                file[f"{key}"] = data
-                session.write()
+            self._put(f"{key}", data)
 
+    @locked
     def get(self, key: str, default=None):
         """
         Obtiene el valor asociado con una clave. Si la clave no existe, devuelve el valor predeterminado.
         """
-
-        if DDB.at(f"{self.file_name}", key=key).exists():
-            log.debug("DDB EXISTS!!!!!!!!!!!!!!!!")
-            return DDB.at(f"{self.file_name}", key=f"{key}").read()
-        log.debug("DDB DOES NOT EXISTS!!!!!!!!!!!!!!!!")
+        entry = self._load(f"{key}")
+        if entry is not None:
+            return entry
         return default
+
+    def peek(self, key):
+        """
+        Resuelve get(key) solo con la cache y sin esperar por el candado.
+        Devuelve NOT_CACHED si para responder habria que leer el disco.
+        """
+        if not self._lock.acquire(blocking=False):
+            return NOT_CACHED
+        try:
+            key = f"{key}"
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            if self._complete or key in self._removed:
+                return None
+            return NOT_CACHED
+        finally:
+            self._lock.release()
+
+    @locked
+    def get_many(self, keys):
+        """
+        Obtiene las entradas (marca de tiempo, valor) de varias claves. Las que
+        no estan en la cache se buscan en una sola lectura de la base de datos.
+
+        Returns:
+            Un diccionario clave -> entrada con las claves encontradas.
+        """
+        found = {}
+        missing = []
+        for key in map(str, keys):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                found[key] = self._cache[key]
+            elif not self._complete and key not in self._removed:
+                missing.append(key)
+
+        if missing:
+            data = DDB.at(f"{self.file_name}").read()
+            for key in missing:
+                entry = data.get(key)
+                if entry is not None:
+                    found[key] = self._cache[key] = from_json(entry)
+            self._evict()
+        return found
+
+    @locked
+    def set_many(self, entries, keep_newer=True):
+        """
+        Almacena varias entradas (clave, (marca de tiempo, valor)) con un unico volcado.
+
+        Args:
+            entries: Iterable de pares (clave, entrada).
+            keep_newer (bool): Si es True, como en set, no se sustituye una
+                               entrada por otra con una marca de tiempo anterior.
+        """
+        entries = [(f"{key}", tuple(entry)) for key, entry in entries
+                   if entry is not None]
+        current = self.get_many(key for key, _ in entries) if keep_newer else {}
+        for key, entry in entries:
+            old = current.get(key)
+            if old is not None and entry[0] < old[0]:
+                continue
+            self._put(key, entry, flush=False)
+        self._maybe_flush()
     
+    @locked
     def iter_older_than(self, seconds_old):
         """
         Itera sobre las claves y valores más antiguos que un tiempo dado.
         """
         min_birthday = time.monotonic() - seconds_old
-        zipped = self._triple_iter()
-        matches = takewhile(lambda r: min_birthday >= r[1], zipped)
-        return list(map(operator.itemgetter(0, 2), matches))
+        keys = self._expiry.older_than(min_birthday)
+        return [(key, self[key]) for key in keys]
 
     def _triple_iter(self):
         """
         Itera sobre las claves, las marcas de tiempo y los valores de la base de datos.
         """
-        data = DDB.at(f"{self.file_name}").read()
-        keys = data.keys()
-        birthday = map(operator.itemgetter(0), data.values())
-        values = map(operator.itemgetter(1), data.values())
+        data = self._read_all()
+        keys = list(data.keys())
+        entries = list(data.values())
+        birthday = map(operator.itemgetter(0), entries)
+        values = map(operator.itemgetter(1), entries)
         return zip(keys, birthday, values)
 
+    @locked
     def __iter__(self):
         """
         Itera sobre las claves y valores de la base de datos.
         """
-        data = DDB.at(f"{self.file_name}").read()
-        keys = data.keys()
-        values = map(operator.itemgetter(1), data.values())
+        data = self._read_all()
+        keys = list(data.keys())
+        values = map(operator.itemgetter(1), list(data.values()))
         return zip(keys, values)
 
+    @locked
     def __repr__(self):
         """
         Devuelve una representación de cadena de la base de datos.
         """
-        return repr(DDB.at(f"{self.file_name}").read())
+        return repr(dict(self._read_all()))
     
+    @locked
     def __len__(self):
         """
         Devuelve la cantidad de claves almacenadas en la base de datos.
         """
-        data = DDB.at(f"{self.file_name}").read()
-        return len(data)
+        return len(self._read_all())
 
 class ForgetfulStorage(Storage):
     """
     Implementación de almacenamiento que no persiste datos.
     """
+
+    blocking = False
     def __init__(self, ttl=604800):
         """
         Inicializa el almacenamiento.
         """
         self.data = OrderedDict()
         self.ttl = ttl
+        self._expiry = ExpiryHeap()
+
+    def flush(self):
+        """
+        No hay nada que volcar: los datos solo viven en memoria.
+        """
 
     def __setitem__(self, key, value):
         """
@@ -146,46 +453,85 @@ class ForgetfulStorage(Storage):
         if key in self.data:
             del self.data[key]
         self.data[key] = (time.monotonic(), value)
-        self.cull()
+        self._expiry.push(key, self.data[key][0])
 
     def cull(self):
         """
         Elimina las claves y valores que han caducado (más viejos que el TTL).
         """
-        for _, _ in self.iter_older_than(self.ttl):
-            self.data.popitem(last=False)
+        min_birthday = time.monotonic() - self.ttl
+        for key in self._expiry.pop_expired(min_birthday):
+            del self.data[key]
+
+    def set(self, key, value):
+        """
+        Almacena una entrada (marca de tiempo, valor), salvo que la clave ya
+        tenga una mas nueva.
+        """
+        if value is None:
+            return
+        old = self.data.get(key)
+        if old is not None and value[0] < old[0]:
+            return
+        self.data.pop(key, None)
+        self.data[key] = tuple(value)
+        self._expiry.push(key, value[0])
 
     def get(self, key, default=None):
         """
-        Obtiene un valor asociado con una clave. Si la clave no existe, devuelve el valor predeterminado.
+        Obtiene la entrada (marca de tiempo, valor) de una clave. Si la clave no existe, devuelve el valor predeterminado.
         """
-        self.cull()
-        if key in self.data:
-            return self[key]
-        return default
+        return self.data.get(key, default)
+
+    def peek(self, key):
+        """
+        Todos los datos viven en memoria: equivale a get.
+        """
+        return self.get(key)
+
+    def get_many(self, keys):
+        """
+        Obtiene las entradas (marca de tiempo, valor) de varias claves.
+        """
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def set_many(self, entries, keep_newer=True):
+        """
+        Almacena varias entradas (clave, (marca de tiempo, valor)).
+        """
+        for key, entry in entries:
+            old = self.data.get(key)
+            if keep_newer and old is not None and entry[0] < old[0]:
+                continue
+            self.data.pop(key, None)
+            self.data[key] = tuple(entry)
+            self._expiry.push(key, entry[0])
 
     def __getitem__(self, key):
         """
         Obtiene el valor asociado con una clave.
         """
-        self.cull()
         return self.data[key][1]
 
     def __repr__(self):
         """
         Devuelve una representación de cadena de los datos almacenados.
         """
-        self.cull()
         return repr(self.data)
 
+    def __len__(self):
+        """
+        Devuelve la cantidad de claves almacenadas.
+        """
+        return len(self.data)
+
     def iter_older_than(self, seconds_old):
         """
         Itera sobre las claves y valores más antiguos que un tiempo dado.
         """
         min_birthday = time.monotonic() - seconds_old
-        zipped = self._triple_iter()
-        matches = takewhile(lambda r: min_birthday >= r[1], zipped)
-        return list(map(operator.itemgetter(0, 2), matches))
+        keys = self._expiry.older_than(min_birthday)
+        return [(key, self.data[key][1]) for key in keys]
 
     def _triple_iter(self):
         """
@@ -200,9 +546,606 @@ class ForgetfulStorage(Storage):
         """
         Itera sobre las claves y valores de los datos almacenados.
         """
-        self.cull()
         ikeys = self.data.keys()
         ivalues = map(operator.itemgetter(1), self.data.values())
         return zip(ikeys, ivalues)
 
 
+class LogStorage(Storage):
+    """
+    Almacenamiento estructurado como log: cada escritura se agrega al final
+    del segmento activo y un indice en memoria guarda, para cada clave, el
+    segmento y la posicion de su ultima version.
+
+    Al cerrar un segmento se escribe un archivo de pistas (hint) con su
+    indice, de modo que al reiniciar el indice se reconstruye sin releer los
+    valores. Si un archivo de pistas no se puede leer, se recorre el segmento.
+    Las marcas de tiempo de registros y pistas son de reloj (time.time()); en
+    memoria se convierten a time.monotonic(). La compactacion en segundo plano fusiona los segmentos cerrados
+    descartando las versiones sustituidas, borradas y caducadas.
+    """
+
+    # crc32, marca de tiempo de reloj, largo de la clave, largo del valor, flags
+    HEADER = struct.Struct('>IdHIB')
+    TOMBSTONE = 1
+
+    def __init__(self, name, ttl=604800, segment_size=4 * 1024 * 1024,
+                 compact_threshold=4):
+        """
+        Args:
+            name: Nombre del directorio de la base de datos.
+            ttl (int): Tiempo de vida de las claves, en segundos.
+            segment_size (int): Tamaño en bytes a partir del cual se cierra el segmento activo.
+            compact_threshold (int): Cantidad de segmentos cerrados que dispara una compactacion.
+        """
+        self.ttl = ttl
+        self.segment_size = segment_size
+        self.compact_threshold = compact_threshold
+        self.directory = os.path.join("database", f"{name}")
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._compacting = False
+        self._index = {}
+        self._readers = {}
+        self._segments = []
+        self._expiry = ExpiryHeap()
+        self._load_index()
+        for key, location in self._index.items():
+            self._expiry.push(key, location[3])
+
+        self._active = self._segments[-1] + 1 if self._segments else 1
+        self._segments.append(self._active)
+        self._active_hint = {}
+        self._writer = open(self._path(self._active, 'log'), 'ab')
+
+    def _path(self, segment, ext):
+        return os.path.join(self.directory, "%08d.%s" % (segment, ext))
+
+    @staticmethod
+    def _to_disk(birthday):
+        """
+        Las marcas de time.monotonic() no sobreviven a un reinicio de la
+        maquina: en disco se guarda la hora del reloj (time.time()).
+        """
+        return birthday + time.time() - time.monotonic()
+
+    @staticmethod
+    def _from_disk(stamp):
+        return stamp - time.time() + time.monotonic()
+
+    def _load_index(self):
+        """
+        Reconstruye el indice a partir de los archivos de pistas, o recorriendo
+        los segmentos que no lo tienen (el ultimo activo antes de reiniciar).
+        """
+        for fname in os.listdir(self.directory):
+            if fname.endswith(('.compact', '.tmp')):
+                os.remove(os.path.join(self.directory, fname))
+
+        self._segments = sorted(int(fname.split('.')[0])
+                                for fname in os.listdir(self.directory)
+                                if fname.endswith('.log'))
+        for segment in self._segments:
+            hint = self._read_hint(segment)
+            if hint is None:
+                hint = self._scan(segment)
+                self._write_hint(segment, hint, self._log_size(segment))
+            self._apply_hint(segment, hint)
+
+    def _log_size(self, segment):
+        return os.path.getsize(self._path(segment, 'log'))
+
+    def _read_hint(self, segment):
+        """
+        Lee el archivo de pistas de un segmento. Devuelve None si no existe,
+        esta corrupto o fue escrito para un log de otro tamaño (por ejemplo, si
+        una compactacion se interrumpio entre el reemplazo del log y el de sus
+        pistas).
+        """
+        path = self._path(segment, 'hint')
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as file:
+                hint = pickle.load(file)
+        except Exception as e:
+            log.warning("Could not load hint file %s (%s), rescanning segment",
+                        path, e)
+            return None
+        if isinstance(hint, tuple) and len(hint) == 2:
+            log_size, hint = hint
+            if log_size != self._log_size(segment):
+                log.warning("Hint file %s does not match its log, rescanning "
+                            "segment", path)
+                return None
+        if not isinstance(hint, dict):
+            log.warning("Invalid hint file %s, rescanning segment", path)
+            return None
+        return hint
+
+    def _apply_hint(self, segment, hint):
+        for key, (offset, size, stamp, flags) in hint.items():
+            if flags & self.TOMBSTONE:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = (segment, offset, size, self._from_disk(stamp))
+
+    def _scan(self, segment):
+        """
+        Recorre un segmento y devuelve la ultima entrada de cada clave. Si el
+        final del archivo esta truncado o corrupto se descarta esa parte.
+        """
+        hint = {}
+        path = self._path(segment, 'log')
+        with open(path, 'rb') as file:
+            data = file.read()
+
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            crc, stamp, key_len, value_len, flags = \
+                self.HEADER.unpack_from(data, offset)
+            size = self.HEADER.size + key_len + value_len
+            record = data[offset:offset + size]
+            if len(record) < size or zlib.crc32(record[4:]) != crc:
+                break
+            start = offset + self.HEADER.size
+            key = data[start:start + key_len].decode('utf8')
+            hint[key] = (offset, size, stamp, flags)
+            offset += size
+
+        if offset < len(data):
+            log.warning("Truncating corrupt tail of segment %s", path)
+            with open(path, 'r+b') as file:
+                file.truncate(offset)
+        return hint
+
+    def _write_hint(self, segment, hint, log_size, path=None):
+        """
+        Escribe un archivo de pistas, junto con el tamaño del log al que
+        corresponde, en un temporal; lo fuerza a disco y lo renombra, para que
+        nunca quede uno a medio escribir.
+        """
+        path = path or self._path(segment, 'hint')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump((log_size, hint), file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _reader(self, segment):
+        if segment not in self._readers:
+            self._readers[segment] = open(self._path(segment, 'log'), 'rb')
+        return self._readers[segment]
+
+    def _read_record(self, key, location):
+        """
+        Lee el registro de la posicion indicada por el indice. Devuelve None si
+        no es un registro valido de esa clave.
+        """
+        segment, offset, size, _ = location
+        file = self._reader(segment)
+        file.seek(offset)
+        record = file.read(size)
+        if len(record) != size or size < self.HEADER.size:
+            return None
+        crc, _, key_len, _, _ = self.HEADER.unpack_from(record)
+        bkey = record[self.HEADER.size:self.HEADER.size + key_len]
+        if zlib.crc32(record[4:]) != crc or bkey != key.encode('utf8'):
+            return None
+        return record
+
+    def _read_value(self, key, location):
+        """
+        Lee el valor almacenado en la posicion indicada por el indice. Si el
+        registro no corresponde a la clave (por ejemplo, el log compactado
+        quedo con las pistas viejas tras una caida), se recorre el segmento.
+        """
+        record = self._read_record(key, location)
+        if record is None and location[0] != self._active:
+            self._rescan(location[0])
+            location = self._index.get(key)
+            if location is not None:
+                record = self._read_record(key, location)
+        if record is None:
+            raise KeyError("no valid record for key %s" % key)
+        _, _, key_len, _, _ = self.HEADER.unpack_from(record)
+        return pickle.loads(record[self.HEADER.size + key_len:])
+
+    def _rescan(self, segment):
+        """
+        Reconstruye las pistas de un segmento cerrado recorriendo su log y
+        corrige las entradas del indice que apuntan a él.
+        """
+        log.warning("Stale hint for segment %s, rescanning it", segment)
+        reader = self._readers.pop(segment, None)
+        if reader:
+            reader.close()
+        hint = self._scan(segment)
+        self._write_hint(segment, hint, self._log_size(segment))
+        for key, location in list(self._index.items()):
+            if location[0] != segment:
+                continue
+            entry = hint.get(key)
+            if entry is None or entry[3] & self.TOMBSTONE:
+                del self._index[key]
+                self._expiry.discard(key)
+            else:
+                self._index[key] = (segment, entry[0], entry[1], location[3])
+
+    def _append(self, key, birthday, value, flags=0, sync=True):
+        """
+        Agrega un registro al segmento activo y actualiza el indice.
+        """
+        bkey = key.encode('utf8')
+        bvalue = b'' if flags & self.TOMBSTONE else pickle.dumps(value)
+        stamp = self._to_disk(birthday)
+        body = self.HEADER.pack(0, stamp, len(bkey), len(bvalue), flags)[4:] \
+            + bkey + bvalue
+        record = struct.pack('>I', zlib.crc32(body)) + body
+
+        offset = self._writer.tell()
+        self._writer.write(record)
+        if sync:
+            self._writer.flush()
+        self._active_hint[key] = (offset, len(record), stamp, flags)
+        if flags & self.TOMBSTONE:
+            self._index.pop(key, None)
+            self._expiry.discard(key)
+        else:
+            self._index[key] = (self._active, offset, len(record), birthday)
+            self._expiry.push(key, birthday)
+
+        if offset + len(record) >= self.segment_size:
+            self._rotate()
+
+    def _rotate(self):
+        """
+        Cierra el segmento activo, escribe sus pistas y abre uno nuevo.
+        """
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._writer.close()
+        self._write_hint(self._active, self._active_hint,
+                         self._log_size(self._active))
+
+        self._active += 1
+        self._segments.append(self._active)
+        self._active_hint = {}
+        self._writer = open(self._path(self._active, 'log'), 'ab')
+
+        if len(self._segments) - 1 >= self.compact_threshold and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        """
+        Fusiona los segmentos cerrados en uno solo, conservando unicamente la
+        ultima version viva de cada clave.
+        """
+        with self._lock:
+            self._compacting = True
+            sealed = [s for s in self._segments if s != self._active]
+        try:
+            if len(sealed) > 1:
+                self._merge(sealed)
+        finally:
+            self._compacting = False
+
+    def _merge(self, sealed):
+        latest = {}
+        for segment in sealed:
+            hint = self._read_hint(segment)
+            if hint is None:
+                hint = self._scan(segment)
+            for key, entry in hint.items():
+                latest[key] = (segment,) + entry
+
+        target = sealed[-1]
+        tmp_log = self._path(target, 'log.compact')
+        tmp_hint = self._path(target, 'hint.compact')
+        min_stamp = time.time() - self.ttl
+        hint = {}
+        sources = {segment: open(self._path(segment, 'log'), 'rb') for segment in sealed}
+        try:
+            with open(tmp_log, 'wb') as out:
+                for key, (segment, offset, size, stamp, flags) in latest.items():
+                    if flags & self.TOMBSTONE or stamp <= min_stamp:
+                        continue
+                    sources[segment].seek(offset)
+                    hint[key] = (out.tell(), size, stamp, flags)
+                    out.write(sources[segment].read(size))
+                out.flush()
+                os.fsync(out.fileno())
+                log_size = out.tell()
+        finally:
+            for file in sources.values():
+                file.close()
+        self._write_hint(target, hint, log_size, tmp_hint)
+
+        with self._lock:
+            for key, (segment, offset, _, _, _) in latest.items():
+                location = self._index.get(key)
+                if location is None or location[:2] != (segment, offset):
+                    continue
+                if key in hint:
+                    new_offset, size, _, _ = hint[key]
+                    self._index[key] = (target, new_offset, size, location[3])
+                else:
+                    del self._index[key]
+                    self._expiry.discard(key)
+
+            for segment in sealed:
+                reader = self._readers.pop(segment, None)
+                if reader:
+                    reader.close()
+            os.replace(tmp_log, self._path(target, 'log'))
+            os.replace(tmp_hint, self._path(target, 'hint'))
+            for segment in sealed[:-1]:
+                os.remove(self._path(segment, 'log'))
+                os.remove(self._path(segment, 'hint'))
+                self._segments.remove(segment)
+        log.debug("Compacted segments %s into %s", sealed, target)
+
+    def flush(self):
+        """
+        Fuerza a disco el contenido del segmento activo.
+        """
+        with self._lock:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+
+    def __setitem__(self, key, value):
+        if value is None:
+            return
+        with self._lock:
+            self._append(f"{key}", time.monotonic(), value)
+
+    def set(self, key, value):
+        if value is None:
+            return
+        with self._lock:
+            location = self._index.get(f"{key}")
+            if location is not None and value[0] < location[3]:
+                return
+            self._append(f"{key}", value[0], value[1])
+
+    def get(self, key, default=None):
+        with self._lock:
+            location = self._index.get(f"{key}")
+            if location is None:
+                return default
+            return (location[3], self._read_value(f"{key}", location))
+
+    def __getitem__(self, key):
+        entry = self.get(key)
+        if entry is not None:
+            return entry[1]
+
+    def peek(self, key):
+        """
+        Solo las claves ausentes se resuelven en memoria; los valores estan en disco.
+        """
+        if f"{key}" not in self._index:
+            return None
+        return NOT_CACHED
+
+    def get_many(self, keys):
+        with self._lock:
+            locations = [(f"{key}", self._index.get(f"{key}")) for key in keys]
+            # Se leen en orden de segmento y posicion para recorrer el disco secuencialmente
+            locations = sorted((location, key) for key, location in locations
+                               if location is not None)
+            return {key: (location[3], self._read_value(key, location))
+                    for location, key in locations}
+
+    def set_many(self, entries, keep_newer=True):
+        with self._lock:
+            for key, entry in entries:
+                if entry is None:
+                    continue
+                location = self._index.get(f"{key}")
+                if keep_newer and location is not None and entry[0] < location[3]:
+                    continue
+                self._append(f"{key}", entry[0], entry[1], sync=False)
+            self._writer.flush()
+
+    def cull(self):
+        """
+        Elimina las claves caducadas escribiendo una lapida para cada una.
+        """
+        with self._lock:
+            min_birthday = time.monotonic() - self.ttl
+            for key in self._expiry.pop_expired(min_birthday):
+                self._append(key, min_birthday, None, self.TOMBSTONE)
+
+    def _triple_iter(self):
+        with self._lock:
+            items = list(self._index.items())
+            return iter([(key, location[3], self._read_value(key, location))
+                         for key, location in items])
+
+    def iter_older_than(self, seconds_old):
+        min_birthday = time.monotonic() - seconds_old
+        with self._lock:
+            keys = self._expiry.older_than(min_birthday)
+            return [(key, self._read_value(key, self._index[key])) for key in keys]
+
+    def __iter__(self):
+        return ((key, value) for key, _, value in self._triple_iter())
+
+    def __repr__(self):
+        return repr({key: (birthday, value)
+                     for key, birthday, value in self._triple_iter()})
+
+    def __len__(self):
+        return len(self._index)
+
+
+class SQLiteStorage(Storage):
+    """
+    Almacenamiento sobre SQLite en modo WAL. Cada clave es una fila de una
+    tabla indexada por clave y por marca de tiempo, de modo que las busquedas
+    son por indice y eliminar las claves caducadas es un unico DELETE.
+
+    Las escrituras se agrupan en una transaccion que se confirma tras un
+    intervalo corto, al acumular `commit_threshold` escrituras o al llamar a flush.
+    Las sentencias son constantes, asi que sqlite3 las compila una sola vez y
+    las reutiliza desde su cache de sentencias.
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS kv ("
+              "key TEXT PRIMARY KEY, birthday REAL NOT NULL, value BLOB NOT NULL)")
+    INDEX = "CREATE INDEX IF NOT EXISTS kv_birthday ON kv (birthday)"
+    GET = "SELECT birthday, value FROM kv WHERE key = ?"
+    PUT = "INSERT OR REPLACE INTO kv (key, birthday, value) VALUES (?, ?, ?)"
+    SET = ("INSERT INTO kv (key, birthday, value) VALUES (?, ?, ?) "
+           "ON CONFLICT(key) DO UPDATE SET birthday = excluded.birthday, "
+           "value = excluded.value WHERE excluded.birthday >= kv.birthday")
+    OLDER = "SELECT key, value FROM kv WHERE birthday <= ? ORDER BY birthday"
+    CULL = "DELETE FROM kv WHERE birthday <= ?"
+    # Limite de parametros por sentencia de SQLite
+    MAX_VARIABLES = 500
+
+    # En disco las marcas son de reloj, igual que en LogStorage
+    _to_disk = staticmethod(LogStorage._to_disk)
+    _from_disk = staticmethod(LogStorage._from_disk)
+
+    def __init__(self, name, ttl=604800, commit_interval=0.05,
+                 commit_threshold=256):
+        """
+        Args:
+            name: Nombre de la base de datos.
+            ttl (int): Tiempo de vida de las claves, en segundos.
+            commit_interval (float): Segundos maximos que una escritura espera a ser confirmada.
+            commit_threshold (int): Cantidad de escrituras que provoca una confirmacion.
+        """
+        self.ttl = ttl
+        self.commit_interval = commit_interval
+        self.commit_threshold = commit_threshold
+        os.makedirs("database", exist_ok=True)
+        self.path = os.path.join("database", f"{name}.sqlite3")
+
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._timer = None
+        self._conn = sqlite3.connect(self.path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(self.SCHEMA)
+        self._conn.execute(self.INDEX)
+
+    def _write(self, sql, params, many=False):
+        """
+        Ejecuta una escritura dentro de la transaccion en curso, abriendola si
+        hace falta, y la confirma si se alcanzo el umbral.
+        """
+        if not self._conn.in_transaction:
+            self._conn.execute("BEGIN")
+            self._timer = threading.Timer(self.commit_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+        if many:
+            cursor = self._conn.executemany(sql, params)
+        else:
+            cursor = self._conn.execute(sql, params)
+        self._pending += max(cursor.rowcount, 1)
+        if self._pending >= self.commit_threshold:
+            self.flush()
+
+    @locked
+    def flush(self):
+        """
+        Confirma la transaccion en curso.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._conn.in_transaction:
+            self._conn.execute("COMMIT")
+        self._pending = 0
+
+    @locked
+    def __setitem__(self, key, value):
+        if value is None:
+            return
+        self._write(self.PUT, (f"{key}", time.time(), pickle.dumps(value)))
+
+    @locked
+    def set(self, key, value):
+        if value is None:
+            return
+        self._write(self.SET, (f"{key}", self._to_disk(value[0]),
+                                pickle.dumps(value[1])))
+
+    @locked
+    def get(self, key, default=None):
+        row = self._conn.execute(self.GET, (f"{key}",)).fetchone()
+        if row is None:
+            return default
+        return (self._from_disk(row[0]), pickle.loads(row[1]))
+
+    def __getitem__(self, key):
+        entry = self.get(key)
+        if entry is not None:
+            return entry[1]
+
+    def peek(self, key):
+        return NOT_CACHED
+
+    @locked
+    def get_many(self, keys):
+        keys = [f"{key}" for key in keys]
+        found = {}
+        for i in range(0, len(keys), self.MAX_VARIABLES):
+            chunk = keys[i:i + self.MAX_VARIABLES]
+            sql = ("SELECT key, birthday, value FROM kv WHERE key IN (%s)"
+                   % ", ".join("?" * len(chunk)))
+            for key, birthday, value in self._conn.execute(sql, chunk):
+                found[key] = (self._from_disk(birthday), pickle.loads(value))
+        return found
+
+    @locked
+    def set_many(self, entries, keep_newer=True):
+        rows = [(f"{key}", self._to_disk(entry[0]), pickle.dumps(entry[1]))
+                for key, entry in entries if entry is not None]
+        if rows:
+            self._write(self.SET if keep_newer else self.PUT, rows, many=True)
+
+    @locked
+    def cull(self):
+        """
+        Elimina las claves caducadas con un unico DELETE sobre el indice de marcas de tiempo.
+        """
+        self._write(self.CULL, (time.time() - self.ttl,))
+
+    @locked
+    def iter_older_than(self, seconds_old):
+        min_birthday = time.time() - seconds_old
+        return [(key, pickle.loads(value))
+                for key, value in self._conn.execute(self.OLDER, (min_birthday,))]
+
+    @locked
+    def _triple_iter(self):
+        rows = self._conn.execute("SELECT key, birthday, value FROM kv").fetchall()
+        return iter([(key, self._from_disk(birthday), pickle.loads(value))
+                     for key, birthday, value in rows])
+
+    def __iter__(self):
+        return ((key, value) for key, _, value in self._triple_iter())
+
+    def __repr__(self):
+        return repr({key: (birthday, value)
+                     for key, birthday, value in self._triple_iter()})
+
+    @locked
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
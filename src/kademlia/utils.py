@@ -1,9 +1,16 @@
 """
 General catchall for functions that don't make sense as methods.
 """
+import base64
+import bisect
 import hashlib
+import logging
 import operator
 import asyncio
+import time
+import zlib
+
+log = logging.getLogger(__name__)
 
 
 async def gather_dict(dic):
@@ -83,4 +90,143 @@ def bytes_to_bit_string(bites):
     return "".join(bits)
 
 
+# Prefijo de los valores comprimidos por compress_value
+COMPRESSED_VALUE = b'\x00zlib:'
+
+# Prefijo de la forma anterior, en texto base85, que aun puede estar guardada
+LEGACY_COMPRESSED_VALUE = '\x00zlib:'
+
+
+def compress_value(value, threshold=1024):
+    """
+    Comprime con zlib un valor de texto de mas de `threshold` caracteres. El
+    resultado son los bytes de zlib tras el prefijo COMPRESSED_VALUE, que se
+    guardan y se reenvian tal cual: se comprime una sola vez al publicarlo, y
+    el transporte no vuelve a comprimir los mensajes que lo llevan.
+
+    Los demas valores, y los que no se achican, se devuelven sin cambios.
+    """
+    if not isinstance(value, str) or len(value) <= threshold:
+        return value
+    raw = value.encode('utf8')
+    compressed = COMPRESSED_VALUE + zlib.compress(raw)
+    return compressed if len(compressed) < len(raw) else value
+
+
+def decompress_value(value):
+    """
+    Deshace compress_value. Los valores sin comprimir se devuelven sin cambios.
+    """
+    if isinstance(value, bytes) and value.startswith(COMPRESSED_VALUE):
+        return zlib.decompress(value[len(COMPRESSED_VALUE):]).decode('utf8')
+    if isinstance(value, str) and value.startswith(LEGACY_COMPRESSED_VALUE):
+        packed = base64.b85decode(value[len(LEGACY_COMPRESSED_VALUE):])
+        return zlib.decompress(packed).decode('utf8')
+    return value
+
+
+class LoopMonitor:
+    """
+    Mide cuanto tiempo queda bloqueado el event loop. Programa un callback
+    cada `interval` segundos y registra con cuanto retraso se ejecuta: ese
+    retraso es el tiempo que el loop estuvo ocupado sin poder atender otros
+    datagramas.
+    """
+
+    def __init__(self, interval=0.1, threshold=0.05):
+        """
+        Args:
+            interval (float): Cada cuantos segundos se toma una muestra.
+            threshold (float): Retraso a partir del cual se registra un bloqueo.
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = 0
+        self.stalls = 0
+        self.total_stall = 0.0
+        self.max_stall = 0.0
+        self._expected = None
+        self._handle = None
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self._expected = time.monotonic() + self.interval
+        self._handle = loop.call_later(self.interval, self._tick)
+
+    def stop(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self):
+        now = time.monotonic()
+        stall = max(0.0, now - self._expected)
+        self.samples += 1
+        self.total_stall += stall
+        self.max_stall = max(self.max_stall, stall)
+        if stall >= self.threshold:
+            self.stalls += 1
+            log.warning("Event loop stalled for %.3f seconds", stall)
+        self.start()
+
+    def stats(self):
+        """
+        Devuelve un resumen de las mediciones.
+        """
+        return {
+            'samples': self.samples,
+            'stalls': self.stalls,
+            'total_stall': self.total_stall,
+            'max_stall': self.max_stall,
+            'mean_stall': self.total_stall / self.samples if self.samples else 0.0
+        }
+
+
+class Histogram:
+    """
+    Histograma de latencias con cubetas de limites crecientes (1-2-5 por
+    decada, de 1 ms a 10 s), para observar la cola de la distribucion.
+    """
 
+    BOUNDS = [m * 10 ** e for e in range(-3, 2) for m in (1, 2, 5)][:-2]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        """
+        Registra una muestra, en segundos.
+        """
+        index = bisect.bisect_left(self.BOUNDS, value)
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """
+        Devuelve el limite superior de la cubeta que contiene el percentil q (0-100).
+        """
+        if not self.total:
+            return 0.0
+        rank = q / 100 * self.total
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def stats(self):
+        """
+        Devuelve un resumen con la cantidad de muestras, la media y los percentiles 50, 95 y 99.
+        """
+        return {
+            'count': self.total,
+            'mean': self.sum / self.total if self.total else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': dict(zip(self.BOUNDS + [float('inf')], self.counts))
+        }
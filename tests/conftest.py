@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Los paquetes viven en src/, como en los contenedores
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
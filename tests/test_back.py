@@ -0,0 +1,57 @@
+from agenda_back.back import Agenda
+
+
+class FakeAPI:
+    """
+    Un DHT en memoria; `lagging` hace que las lecturas devuelvan el valor
+    anterior de una clave, como una replica desactualizada.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.previous = {}
+        self.lagging = False
+        self.fail_writes = False
+
+    def set_value(self, key, value, min_acks=None):
+        if self.fail_writes:
+            return (False, 'Setting value failed!')
+        self.previous[key] = self.values.get(key)
+        self.values[key] = str(value)
+        return (True, 'Success!!')
+
+    def get_value(self, key):
+        value = (self.previous if self.lagging else self.values).get(key)
+        return (value is not None, value)
+
+
+def user(alias, events):
+    return {'class': 'user', 'alias': alias, 'password': '', 'logged': False,
+            'groups': [], 'confirmed_events': [], 'pending_events': events,
+            'created_events': []}
+
+
+def test_session_reads_its_write_while_replica_is_older():
+    api = FakeAPI()
+    agenda = Agenda(api)
+    agenda.set('bob', user('bob', []))
+    agenda.set('bob', user('bob', ['e1']))
+    api.lagging = True
+    assert agenda.get('bob').pending_events == ['e1']
+
+
+def test_newer_write_from_another_session_wins():
+    api = FakeAPI()
+    alice, bob = Agenda(api).session(), Agenda(api).session()
+    alice.set('bob', user('bob', ['e1']))
+    bob.set('bob', user('bob', ['e1', 'e2']))
+    assert alice.get('bob').pending_events == ['e1', 'e2']
+
+
+def test_failed_write_is_not_read_back():
+    api = FakeAPI()
+    agenda = Agenda(api)
+    agenda.set('bob', user('bob', []))
+    api.fail_writes = True
+    agenda.set('bob', user('bob', ['e1']))
+    assert agenda.get('bob').pending_events == []
@@ -0,0 +1,67 @@
+import asyncio
+
+from kademlia.crawling import NodeSpiderCrawl, ValueSpiderCrawl
+from kademlia.node import Node
+
+
+class FakeProtocol:
+    min_timeout = 0.2
+
+    def __init__(self, p95):
+        self.p95 = p95
+
+    def rtt_percentile(self, p):
+        return self.p95
+
+
+def make_crawl(p95, hedge=True):
+    return ValueSpiderCrawl(FakeProtocol(p95), Node(b'\x00' * 20), [], 3, 2,
+                            soft_timeout=0.5, hedge=hedge)
+
+
+def test_hedge_keeps_alpha():
+    assert make_crawl(0.05).alpha == 2
+
+
+def test_hedge_delay_is_clamped_to_min_timeout():
+    assert make_crawl(0.001).soft_timeout == 0.2
+    assert make_crawl(0.3).soft_timeout == 0.3
+
+
+def test_hedge_without_samples_uses_soft_timeout():
+    assert make_crawl(None).soft_timeout == 0.5
+    assert make_crawl(0.3, hedge=False).soft_timeout == 0.5
+
+
+class SlowPeerProtocol(FakeProtocol):
+    """
+    Un unico par que responde despues del plazo blando de la busqueda.
+    """
+
+    def __init__(self, delay, value=None):
+        FakeProtocol.__init__(self, None)
+        self.delay = delay
+        self.value = value
+
+    async def call_find_node(self, peer, node):
+        await asyncio.sleep(self.delay)
+        return (True, [])
+
+    async def call_find_value(self, peer, node):
+        await asyncio.sleep(self.delay)
+        return (True, {'value': self.value})
+
+
+def test_slow_single_peer_is_not_dropped_from_node_lookup():
+    peer = Node(b'\x01' * 20, '127.0.0.1', 9000)
+    crawl = NodeSpiderCrawl(SlowPeerProtocol(0.15), Node(b'\x00' * 20),
+                            [peer], 3, 2, soft_timeout=0.05)
+    assert asyncio.run(crawl.find()) == [peer]
+
+
+def test_slow_single_peer_still_returns_its_value():
+    peer = Node(b'\x01' * 20, '127.0.0.1', 9000)
+    protocol = SlowPeerProtocol(0.15, value=[1.0, 'v'])
+    crawl = ValueSpiderCrawl(protocol, Node(b'\x00' * 20), [peer], 3, 2,
+                             soft_timeout=0.05)
+    assert asyncio.run(crawl.find()) == [1.0, 'v']
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import pytest
+
+from api_and_controllers.gateway import Gateway
+
+
+class FakeAgenda:
+    def __init__(self):
+        self.admin_calls = []
+
+    def session(self):
+        return self
+
+    def get_all_users(self):
+        return ['alice', 'bob']
+
+    def sudo(self, action, n_s):
+        self.admin_calls.append((action, n_s))
+
+
+async def call(reader, writer, request_id, method, token=None, params=()):
+    request = {'id': request_id, 'session': token, 'method': method,
+               'params': list(params)}
+    writer.write(json.dumps(request).encode() + b'\n')
+    await writer.drain()
+    return json.loads(await reader.readline())
+
+
+def run_gateway(scenario, **kwargs):
+    async def main():
+        gateway = Gateway(FakeAgenda(), port=0, **kwargs)
+        await gateway.start()
+        port = gateway.server.sockets[0].getsockname()[1]
+        try:
+            await scenario(gateway, port)
+        finally:
+            gateway.stop()
+            await gateway.server.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_sessions_are_closed_with_their_connection():
+    async def scenario(gateway, port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        token = (await call(reader, writer, 1, 'open_session'))['result']
+        answer = await call(reader, writer, 2, 'get_all_users', token)
+        assert answer['result'] == ['alice', 'bob']
+        assert token in gateway.sessions
+
+        writer.close()
+        await writer.wait_closed()
+        for _ in range(100):
+            if not gateway.sessions:
+                break
+            await asyncio.sleep(0.01)
+        assert gateway.sessions == {}
+        assert gateway.locks == {}
+
+    run_gateway(scenario)
+
+
+def test_admin_methods_are_disabled_by_default():
+    async def scenario(gateway, port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        token = (await call(reader, writer, 1, 'open_session'))['result']
+        answer = await call(reader, writer, 2, 'sudo', token, ['create', 1])
+        assert 'error' in answer
+        assert gateway.agenda.admin_calls == []
+        writer.close()
+        await writer.wait_closed()
+
+    run_gateway(scenario)
+
+
+def test_admin_methods_need_a_loopback_interface():
+    with pytest.raises(ValueError):
+        Gateway(FakeAgenda(), host='0.0.0.0', allow_admin=True)
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+from kademlia.network import Server
+from kademlia.node import Node
+from kademlia.storage import ForgetfulStorage
+from kademlia.utils import digest
+
+
+class RecordingStorage(ForgetfulStorage):
+    blocking = True
+
+    def __init__(self):
+        ForgetfulStorage.__init__(self)
+        self.flushed_in = []
+
+    def flush(self):
+        self.flushed_in.append(threading.current_thread())
+
+
+def test_stop_flushes_off_the_loop_and_keeps_storage_usable():
+    async def run():
+        storage = RecordingStorage()
+        server = Server('127.0.0.1', storage=storage)
+        await server.listen(0, '127.0.0.1')
+        server.stop()
+        assert server.flush_loop.cancelled() and server.cull_loop.cancelled()
+
+        # Las operaciones que llegan tras detenerse se hacen en linea
+        storage['k'] = 'v'
+        assert await server.protocol.run_storage(storage.get, 'k') is not None
+        await asyncio.sleep(0.05)
+        return storage.flushed_in
+
+    # El volcado final va al hilo de entrada/salida
+    flushed_in = asyncio.run(run())
+    assert any(thread is not threading.main_thread() for thread in flushed_in)
+
+
+def run_network(count, scenario, first_port):
+    """
+    Levanta `count` nodos locales con IDs distintos y ejecuta `scenario`.
+    """
+    async def run():
+        servers = [Server('127.0.0.1', node_id='node%i' % i,
+                          storage=ForgetfulStorage()) for i in range(count)]
+        for port, server in enumerate(servers, first_port):
+            await server.listen(port, '127.0.0.1')
+        for server in servers[1:]:
+            await server.bootstrap([('127.0.0.1', first_port)])
+        try:
+            return await scenario(servers)
+        finally:
+            for server in servers:
+                server.stop()
+
+    return asyncio.run(run())
+
+
+def count_calls(obj, name, calls):
+    method = getattr(obj, name)
+
+    async def counted(*args):
+        calls[name] = calls.get(name, 0) + 1
+        return await method(*args)
+
+    setattr(obj, name, counted)
+
+
+def test_get_many_batches_keys_per_node():
+    async def scenario(servers):
+        for i in range(20):
+            await servers[1].set('key%i' % i, 'value%i' % i)
+        await asyncio.sleep(0.2)
+        client, calls = servers[-1], {}
+        count_calls(client.protocol, 'call_find_values', calls)
+        count_calls(client, 'get', calls)
+        keys = ['key%i' % i for i in range(20)] + ['missing']
+        contacts = {n.id for key in keys for n in
+                    client.protocol.router.find_neighbors(Node(digest(key)))}
+        return await client.get_many(keys), calls, len(contacts)
+
+    found, calls, contacts = run_network(6, scenario, 9750)
+    assert found == {'key%i' % i: 'value%i' % i for i in range(20)}
+    # Una llamada por contacto, no una por clave; solo 'missing' cae en get
+    assert 1 < calls['call_find_values'] == contacts < 20
+    assert calls['get'] == 1
+
+
+def test_get_many_returns_the_newest_replica():
+    async def scenario(servers):
+        await servers[1].set('key', 'old')
+        await asyncio.sleep(0.2)
+        client = servers[-1]
+        dkey = digest('key')
+        replicas = client.protocol.router.find_neighbors(Node(dkey))
+        # Solo la replica mas lejana que tiene la clave recibio la escritura nueva
+        holders = [s for n in replicas for s in servers
+                   if s.node.id == n.id and s.storage.get(dkey) is not None]
+        assert len(holders) > 1
+        newest = holders[-1]
+        birthday = newest.storage.get(dkey)[0]
+        newest.storage.set(dkey, (birthday + 1, 'new'))
+        return await client.get_many(['key'])
+
+    assert run_network(6, scenario, 9760) == {'key': 'new'}
@@ -0,0 +1,85 @@
+from kademlia.node import Node, NodeHeap, pack_nodes, unpack_nodes
+
+
+def make_node(long_id):
+    return Node(long_id.to_bytes(20, 'big'), '127.0.0.1', 8000 + long_id)
+
+
+def test_heap_keeps_the_closest_nodes():
+    heap = NodeHeap(make_node(0), 3)
+    heap.push([make_node(i) for i in range(10, 0, -1)])
+    assert [n.long_id for n in heap] == [1, 2, 3]
+
+
+def test_remove_refills_from_evicted_candidates():
+    heap = NodeHeap(make_node(0), 3)
+    heap.push([make_node(i) for i in range(1, 8)])
+    heap.remove([make_node(2).id])
+    assert [n.long_id for n in heap] == [1, 3, 4]
+    heap.remove([make_node(1).id, make_node(3).id])
+    assert [n.long_id for n in heap] == [4, 5, 6]
+
+
+def test_removed_nodes_do_not_come_back():
+    heap = NodeHeap(make_node(0), 2)
+    heap.push([make_node(i) for i in range(1, 5)])
+    heap.remove([make_node(3).id])
+    heap.remove([make_node(1).id])
+    assert [n.long_id for n in heap] == [2, 4]
+
+
+def test_popleft_refills():
+    heap = NodeHeap(make_node(0), 1)
+    heap.push([make_node(3), make_node(1), make_node(2)])
+    assert heap.popleft().long_id == 1
+    assert heap.popleft().long_id == 2
+    assert heap.popleft().long_id == 3
+    assert heap.popleft() is None
+
+
+def test_spare_candidates_are_bounded():
+    heap = NodeHeap(make_node(0), 4)
+    heap.push([make_node(i) for i in range(1, 200)])
+    assert len(heap) == 4
+    assert len(heap.spare_nodes) <= 8
+    heap.remove([n.id for n in list(heap)])
+    assert [n.long_id for n in heap] == [5, 6, 7, 8]
+
+
+def test_contacted_and_uncontacted():
+    heap = NodeHeap(make_node(0), 3)
+    nodes = [make_node(i) for i in range(1, 4)]
+    heap.push(nodes)
+    heap.mark_contacted(nodes[0])
+    assert heap.get_uncontacted() == nodes[1:]
+    assert not heap.have_contacted_all()
+    assert nodes[0] in heap
+
+
+def test_pack_nodes_round_trip():
+    nodes = [make_node(1), make_node(2),
+             Node(make_node(3).id, '2001:db8::1', 4000)]
+    unpacked = unpack_nodes(pack_nodes(nodes))
+    assert [(n.id, n.ip, n.port) for n in unpacked] == \
+        [(n.id, n.ip, n.port) for n in nodes]
+
+
+def test_pack_nodes_without_numeric_ip_falls_back_to_tuples():
+    node = Node(make_node(1).id, 'localhost', 8000)
+    assert pack_nodes([node]) == [(node.id, 'localhost', 8000)]
+
+
+def test_unpack_truncated_blob_keeps_complete_contacts():
+    blob = pack_nodes([make_node(1), make_node(2)])
+    for cut in range(len(blob) - 26, len(blob)):
+        assert [n.long_id for n in unpack_nodes(blob[:cut])] == [1]
+    assert unpack_nodes(blob[:5]) == []
+
+
+def test_unpack_malformed_blobs():
+    blob = pack_nodes([make_node(1)])
+    assert unpack_nodes(b'') == []
+    assert unpack_nodes(b'\xff' + blob[1:]) == []
+    bad_size = blob[:21] + b'\x07' + blob[22:]
+    assert unpack_nodes(bad_size) == []
+    assert [n.long_id for n in unpack_nodes(blob + b'\x00' * 3)] == [1]
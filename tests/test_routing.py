@@ -0,0 +1,83 @@
+import asyncio
+import random
+
+import pytest
+
+from kademlia import nodearray
+from kademlia.node import Node
+from kademlia.nodearray import NodeArray
+from kademlia.routing import RoutingTable
+
+
+class FakeProtocol:
+    async def call_ping(self, node):
+        return None
+
+
+def make_node(long_id, port=8000):
+    return Node(long_id.to_bytes(20, 'big'), '10.0.0.1', port)
+
+
+def make_table(count, ksize=4, seed=1):
+    rng = random.Random(seed)
+
+    async def fill():
+        table = RoutingTable(FakeProtocol(), ksize,
+                             make_node(rng.getrandbits(160)))
+        for port in range(count):
+            table.add_contact(make_node(rng.getrandbits(160), port))
+        return table
+
+    return asyncio.run(fill())
+
+
+def table_contacts(table):
+    return [n for bucket in table.buckets for n in bucket.nodes.values()]
+
+
+def brute_force(table, target, k, exclude=None):
+    candidates = [n for n in table_contacts(table) if n.id != target.id
+                  and (exclude is None or not n.same_home_as(exclude))]
+    return sorted(candidates, key=lambda n: n.long_id ^ target.long_id)[:k]
+
+
+def test_get_bucket_for_returns_the_bucket_in_range():
+    table = make_table(200)
+    for node in table_contacts(table):
+        bucket = table.buckets[table.get_bucket_for(node)]
+        assert bucket.has_in_range(node)
+
+
+@pytest.mark.parametrize('k', [1, 4, 20])
+def test_find_neighbors_matches_brute_force(k):
+    table = make_table(300)
+    table.index = None
+    rng = random.Random(2)
+    targets = [make_node(rng.getrandbits(160)) for _ in range(50)]
+    targets += table_contacts(table)[:10]
+    for target in targets:
+        assert table.find_neighbors(target, k) == brute_force(table, target, k)
+
+
+def test_find_neighbors_skips_excluded_address():
+    table = make_table(100)
+    table.index = None
+    contacts = table_contacts(table)
+    target, excluded = contacts[0], contacts[1]
+    neighbors = table.find_neighbors(target, 10, exclude=excluded)
+    assert excluded not in neighbors
+    assert neighbors == brute_force(table, target, 10, exclude=excluded)
+
+
+@pytest.mark.parametrize('numpy', [nodearray.numpy, None])
+def test_indexed_find_neighbors_matches_brute_force(monkeypatch, numpy):
+    monkeypatch.setattr(nodearray, 'numpy', numpy)
+    table = make_table(300)
+    table.index = NodeArray()
+    for node in table_contacts(table):
+        table.index.add(node)
+    table.index_threshold = 0
+    rng = random.Random(3)
+    for _ in range(20):
+        target = make_node(rng.getrandbits(160))
+        assert table.find_neighbors(target, 8) == brute_force(table, target, 8)
@@ -0,0 +1,168 @@
+import asyncio
+import os
+import time
+
+import umsgpack
+
+from kademlia.rpcudp import (ACCEPTS_COMPRESSION, COMPRESSED, FRAGMENT, HELLO,
+                             RPCProtocol)
+from kademlia.utils import compress_value
+
+
+def test_unmeasured_peer_uses_initial_timeout():
+    protocol = RPCProtocol(wait_timeout=5, initial_timeout=1)
+    assert protocol.rto(('127.0.0.1', 1)) == 1
+    protocol._rtt[('127.0.0.1', 1)] = (0.01, 0.005)
+    assert protocol.rto(('127.0.0.1', 1)) == protocol.min_timeout
+
+
+def test_dead_peer_fails_within_wait_timeout():
+    async def call_dead_peer():
+        loop = asyncio.get_event_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: RPCProtocol(wait_timeout=0.6, initial_timeout=0.4),
+            local_addr=('127.0.0.1', 0))
+        try:
+            start = time.monotonic()
+            result = await protocol.ping(('127.0.0.1', 9), b'x')
+            return result, time.monotonic() - start
+        finally:
+            transport.close()
+
+    result, elapsed = asyncio.run(call_dead_peer())
+    assert result == (False, None)
+    assert elapsed < 0.6 + 0.1
+
+
+def test_dispatch_calls_plain_and_coroutine_methods():
+    class Protocol(RPCProtocol):
+        def rpc_echo(self, sender, value):
+            return value
+
+        async def rpc_double(self, sender, value):
+            return 2 * value
+
+    protocol = Protocol()
+    address = ('127.0.0.1', 1)
+    assert asyncio.run(protocol._dispatch(['echo', [1]], address)) == (True, 1)
+    assert asyncio.run(protocol._dispatch(['double', [2]], address)) == (True, 4)
+    assert asyncio.run(protocol._dispatch(['nope', []], address)) == (False, None)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+
+def test_flags_are_only_sent_after_a_hello():
+    protocol = RPCProtocol(compress_threshold=16)
+    protocol.transport = FakeTransport()
+    peer = ('127.0.0.1', 1)
+    payload = b'a' * 100
+    assert protocol._frame(0x00, bytes(20), payload, peer)[0] == 0x00
+    assert protocol.transport.sent[0][0][0] == HELLO
+    # Solo un saludo por par
+    protocol._frame(0x00, bytes(20), payload, peer)
+    assert len(protocol.transport.sent) == 1
+
+    asyncio.run(protocol._solve_datagram(protocol.transport.sent[0][0], peer))
+    framed = protocol._frame(0x00, bytes(20), payload, peer)
+    assert framed[0] == COMPRESSED | ACCEPTS_COMPRESSION
+    assert protocol._payload(framed, peer) == payload
+
+
+def test_compressed_values_are_not_recompressed():
+    protocol = RPCProtocol(compress_threshold=16)
+    peer = ('127.0.0.1', 1)
+    protocol._compress_peers.add(peer)
+    value = compress_value('x' * 5000)
+    payload = umsgpack.packb(['store', [b'id', 'key', value]])
+    framed = protocol._frame(0x00, bytes(20), payload, peer)
+    assert framed[0] == ACCEPTS_COMPRESSION
+    assert framed[21:] == payload
+
+
+def fragment(msg_id, index, count, chunk=b'x'):
+    return b'\x03' + b'\x00' + msg_id + FRAGMENT.pack(index, count) + chunk
+
+
+def test_malformed_fragments_are_ignored():
+    async def receive():
+        protocol = RPCProtocol(max_partials=4)
+        protocol.transport = FakeTransport()
+        peer = ('127.0.0.1', 1)
+        # Demasiado corto para llevar la cabecera del fragmento
+        await protocol._solve_datagram(b'\x03' + bytes(23), peer)
+        assert protocol._accept_fragment(fragment(bytes(20), 0, 0), peer) is None
+        assert protocol._accept_fragment(fragment(bytes(20), 2, 2), peer) is None
+        assert protocol._partials == {}
+
+        for i in range(10):
+            protocol._accept_fragment(fragment(bytes([i]) * 20, 0, 2), peer)
+        assert len(protocol._partials) == 4
+        for key in list(protocol._partials):
+            protocol._drop_partial(key)
+
+    asyncio.run(receive())
+
+
+class LossyTransport:
+    """
+    Descarta la primera vez cada fragmento de indice impar.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.dropped = set()
+        self.kinds = []
+
+    def sendto(self, data, address):
+        self.kinds.append(data[0])
+        if data[0] == 0x03:
+            index, _ = FRAGMENT.unpack_from(data, 22)
+            if index % 2 and (data[1:22], index) not in self.dropped:
+                self.dropped.add((data[1:22], index))
+                return
+        self.transport.sendto(data, address)
+
+
+def test_lost_fragments_are_recovered_and_small_calls_batched():
+    class Protocol(RPCProtocol):
+        def rpc_echo(self, sender, value):
+            return value
+
+    async def exchange():
+        loop = asyncio.get_event_loop()
+        protocols = []
+        for _ in range(2):
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: Protocol(wait_timeout=5, initial_timeout=2,
+                                 compress_threshold=None),
+                local_addr=('127.0.0.1', 0))
+            protocol.transport = LossyTransport(transport)
+            protocols.append(protocol)
+        client, server = protocols
+        address = server.transport.transport.get_extra_info('sockname')
+        try:
+            value = os.urandom(6000)
+            start = time.monotonic()
+            result = await client.echo(address, value)
+            elapsed = time.monotonic() - start
+            small = await asyncio.gather(*(client.echo(address, i)
+                                           for i in range(20)))
+            return result, value, elapsed, small, client, server
+        finally:
+            for protocol in protocols:
+                protocol.transport.transport.close()
+
+    result, value, elapsed, small, client, server = asyncio.run(exchange())
+    assert result == (True, value)
+    # Los fragmentos perdidos se piden con un NACK, sin esperar al reenvio
+    assert elapsed < 1
+    assert client.transport.dropped and server.transport.dropped
+    assert 0x04 in client.transport.kinds and 0x04 in server.transport.kinds
+    assert small == [(True, i) for i in range(20)]
+    assert 0x02 in client.transport.kinds
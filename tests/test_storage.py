@@ -0,0 +1,184 @@
+import os
+import pickle
+import time
+
+from kademlia import storage
+from kademlia.storage import ExpiryHeap, LogStorage, SQLiteStorage
+
+
+def test_pop_expired_returns_oldest_keys():
+    heap = ExpiryHeap()
+    heap.push('a', 1.0)
+    heap.push('b', 2.0)
+    heap.push('c', 3.0)
+    assert heap.pop_expired(2.0) == ['a', 'b']
+    assert len(heap) == 1
+
+
+def test_push_again_with_same_birthday():
+    heap = ExpiryHeap()
+    heap.push('k', 1.0)
+    heap.push('k', 1.0)
+    assert len(heap.heap) == 1
+    assert heap.older_than(5) == ['k']
+    assert heap.pop_expired(5) == ['k']
+    assert len(heap) == 0
+
+
+def test_duplicate_heap_entries_are_popped_once():
+    heap = ExpiryHeap()
+    heap.push('k', 1.0)
+    heap.heap.append((1.0, 'k'))
+    assert heap.older_than(5) == ['k']
+    assert heap.pop_expired(5) == ['k']
+    assert heap.pop_expired(5) == []
+
+
+def test_refreshed_key_keeps_only_its_new_birthday():
+    heap = ExpiryHeap()
+    heap.push('k', 1.0)
+    heap.push('k', 10.0)
+    assert heap.pop_expired(5) == []
+    assert heap.older_than(10) == ['k']
+
+
+def test_discard():
+    heap = ExpiryHeap()
+    heap.push('k', 1.0)
+    heap.discard('k')
+    assert heap.pop_expired(5) == []
+
+
+def test_log_storage_keeps_key_age_across_clock_restart(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    log_storage = LogStorage('node', segment_size=64)
+    log_storage['a'] = 'x' * 100
+    log_storage['b'] = 'y'
+    log_storage.flush()
+    age = time.monotonic() - log_storage.get('a')[0]
+
+    # Tras reiniciar la maquina el reloj monotono vuelve a empezar
+    offset = time.monotonic() - 5
+    monkeypatch.setattr(storage.time, 'monotonic',
+                        lambda: time.perf_counter() - offset)
+    reopened = LogStorage('node', segment_size=64)
+    for key in ('a', 'b'):
+        birthday, _ = reopened.get(key)
+        assert abs(storage.time.monotonic() - birthday - age) < 1
+    assert reopened['a'] == 'x' * 100
+
+
+def test_sqlite_storage_keeps_key_age_across_clock_restart(tmp_path,
+                                                          monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sqlite_storage = SQLiteStorage('node', ttl=60)
+    sqlite_storage.set('old', (time.monotonic() - 120, 'x'))
+    sqlite_storage['a'] = 'y'
+    sqlite_storage.flush()
+    age = time.monotonic() - sqlite_storage.get('a')[0]
+
+    # Tras reiniciar la maquina el reloj monotono vuelve a empezar
+    offset = time.monotonic() - 5
+    monkeypatch.setattr(storage.time, 'monotonic',
+                        lambda: time.perf_counter() - offset)
+    reopened = SQLiteStorage('node', ttl=60)
+    birthday, _ = reopened.get('a')
+    assert abs(storage.time.monotonic() - birthday - age) < 1
+
+    # Un refresco posterior al reinicio sigue ganando a la copia guardada
+    reopened.set('a', (storage.time.monotonic(), 'z'))
+    reopened.cull()
+    reopened.flush()
+    assert reopened['a'] == 'z'
+    assert reopened.get('old') is None
+
+
+def test_log_storage_rebuilds_corrupt_hint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    log_storage = LogStorage('node', segment_size=64)
+    log_storage['a'] = 'x' * 100
+    log_storage['b'] = 'y'
+    hint_path = log_storage._path(1, 'hint')
+    with open(hint_path, 'wb') as file:
+        file.write(b'not a pickle')
+
+    reopened = LogStorage('node', segment_size=64)
+    assert reopened['a'] == 'x' * 100
+    assert reopened['b'] == 'y'
+    with open(hint_path, 'rb') as file:
+        assert set(pickle.load(file)[1]) == {'a'}
+    assert not [f for f in os.listdir(reopened.directory) if f.endswith('.tmp')]
+
+
+def test_forgetful_storage_returns_entries():
+    memory = storage.ForgetfulStorage()
+    memory['k'] = 'a' * 100
+    birthday, value = memory.get('k')
+    assert value == 'a' * 100
+    assert memory.peek('k') == (birthday, value)
+    assert memory.get('missing') is None
+    assert memory['k'] == 'a' * 100
+
+
+def test_forgetful_storage_set_keeps_newer_entry():
+    memory = storage.ForgetfulStorage()
+    memory.set('k', (2.0, 'new'))
+    memory.set('k', (1.0, 'old'))
+    assert memory.get('k') == (2.0, 'new')
+    memory.set('k', (3.0, 'newer'))
+    assert memory.get('k') == (3.0, 'newer')
+
+
+def fill_and_compact(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    log_storage = LogStorage('node', segment_size=64, compact_threshold=100)
+    for i in range(12):
+        log_storage['k%i' % (i % 4)] = 'v%i-' % i + 'x' * 60
+    return log_storage
+
+
+def test_log_storage_recovers_from_crash_between_compaction_renames(
+        tmp_path, monkeypatch):
+    log_storage = fill_and_compact(monkeypatch, tmp_path)
+    sealed = [s for s in log_storage._segments if s != log_storage._active]
+    old_hint = log_storage._path(sealed[-1], 'hint')
+    with open(old_hint, 'rb') as file:
+        stale = file.read()
+    log_storage.compact()
+    # Caida entre el reemplazo del log y el de sus pistas
+    with open(old_hint, 'wb') as file:
+        file.write(stale)
+
+    reopened = LogStorage('node', segment_size=64)
+    for i in range(8, 12):
+        assert reopened['k%i' % (i % 4)] == 'v%i-' % i + 'x' * 60
+
+
+def test_log_storage_rescans_when_a_record_does_not_match(tmp_path,
+                                                          monkeypatch):
+    log_storage = fill_and_compact(monkeypatch, tmp_path)
+    sealed = [s for s in log_storage._segments if s != log_storage._active]
+    log_storage.compact()
+    target = sealed[-1]
+    # Pistas del tamaño correcto pero con las posiciones cambiadas
+    with open(log_storage._path(target, 'hint'), 'rb') as file:
+        log_size, hint = pickle.load(file)
+    keys = list(hint)
+    hint[keys[0]], hint[keys[1]] = hint[keys[1]], hint[keys[0]]
+    log_storage._write_hint(target, hint, log_size)
+
+    reopened = LogStorage('node', segment_size=64)
+    values = dict(reopened)
+    assert values == {'k%i' % (i % 4): 'v%i-' % i + 'x' * 60
+                      for i in range(8, 12)}
+
+
+def test_json_storage_keeps_bytes_values(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    json_storage = storage.Storage('node', cache_size=1)
+    json_storage['a'] = b'\x00zlib:\xff\x00'
+    json_storage['b'] = 'text'
+    json_storage.flush()
+    assert json_storage.get('a')[1] == b'\x00zlib:\xff\x00'
+    reopened = storage.Storage('node')
+    assert dict(reopened) == {'a': b'\x00zlib:\xff\x00', 'b': 'text'}
@@ -0,0 +1,28 @@
+import zlib
+
+from kademlia.utils import COMPRESSED_VALUE, compress_value, decompress_value
+
+
+def test_compress_value_round_trip():
+    value = str([{'title': 'event %i' % i, 'participants': ['a', 'b']}
+                 for i in range(200)])
+    compressed = compress_value(value)
+    assert isinstance(compressed, bytes)
+    assert compressed.startswith(COMPRESSED_VALUE)
+    assert len(compressed) == len(COMPRESSED_VALUE) + len(
+        zlib.compress(value.encode('utf8')))
+    assert decompress_value(compressed) == value
+
+
+def test_small_and_non_text_values_are_unchanged():
+    assert compress_value('short') == 'short'
+    assert compress_value(12) == 12
+    assert decompress_value('plain') == 'plain'
+
+
+def test_legacy_base85_values_still_decompress():
+    import base64
+    value = 'x' * 5000
+    legacy = '\x00zlib:' + base64.b85encode(
+        zlib.compress(value.encode('utf8'))).decode('ascii')
+    assert decompress_value(legacy) == value